@@ -0,0 +1,271 @@
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import platform
+import resource
+from collections import Counter
+from multiprocessing import get_context
+import numpy as np
+import RNA
+
+# Repeatable timings for the folding modes over a fixed corpus
+#     RNAstrand: the same few records from each length bin of RNAstrand_noMS_noPK.dp every time
+#     SRP:       the SRP_test construct at its measured lengths, with the mean BzCN reactivities for shape_constraint
+# Every pathway is folded with the notebook loop (one call per prefix length) and timed per length.
+# Each (mode, backend) runs in a fresh process so peak RSS isn't polluted by the other modes,
+# and the penalize_barriers* callbacks are wrapped to count how often Vienna calls back into python.
+#
+#     python benchmark.py -o bench.json
+#     python benchmark.py -o new.json --compare bench.json
+#
+# --compare flags any mode that got slower or bigger than the tolerance, and any pathway that changed.
+# Single pathways are too noisy to judge on their own, so times are compared as totals per mode and backend.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DP_FILE = os.path.join(HERE, 'RNAstrand', 'RNAstrand_noMS_noPK.dp')
+SRP_DIR = os.path.join(HERE, 'SRP_test')
+
+LENGTH_BINS = [(20, 50), (50, 100), (100, 150)]
+PER_BIN = 2
+SEED = 1337
+
+MODES = ['no_constraint', 'shape_constraint', 'constant_penalty', 'sequence_dependent_penalty',
+         'constant_ensemble_penalty', 'sequence_dependent_ensemble_penalty']
+ENSEMBLE_MODES = ['constant_ensemble_penalty', 'sequence_dependent_ensemble_penalty']
+
+# Penalty used for each mode, the best values from the SRP notebook's sweeps
+PARAMS = {
+    'no_constraint' : 0,
+    'shape_constraint' : 0,
+    'constant_penalty' : 20,
+    'sequence_dependent_penalty' : 0.05,
+    'constant_ensemble_penalty' : 20,
+    'sequence_dependent_ensemble_penalty' : 0.034
+}
+
+CALLBACKS = ['penalize_barriers', 'penalize_barriers_seq', 'penalize_barriers_ensemble', 'penalize_barriers_ensemble_exp']
+
+# The fixed corpus: {name : {'seq', 'lengths', 'react'}}, react is {length : reactivities} or None
+def corpus(bins=LENGTH_BINS, per_bin=PER_BIN, seed=SEED, srp=True, min_length=11):
+    from utils import iter_dp_file
+    from rdat_store import load_rdat_dir
+
+    out = {}
+    records = dict(iter_dp_file(DP_FILE, min_length=bins[0][0], max_length=bins[-1][1]))
+    rng = random.Random(seed)
+    for low, high in bins:
+        names = sorted(k for k, v in records.items() if low <= len(v['seq']) < high)
+        for k in rng.sample(names, min(per_bin, len(names))):
+            seq = records[k]['seq']
+            out[f'{k} ({low}-{high})'] = {'seq' : seq, 'lengths' : list(range(min_length, len(seq)+1)), 'react' : None}
+
+    if srp and os.path.isdir(SRP_DIR):
+        store = load_rdat_dir(SRP_DIR)
+        mean = store.aggregate('BzCN')
+        out['SRP'] = {'seq' : mean[store.lengths[-1]]['seq'], 'lengths' : store.lengths,
+                      'react' : {l : mean[l]['react'].tolist() for l in store.lengths}}
+
+    return out
+
+def _peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # linux reports kB
+
+# Wrap the callbacks so every call from Vienna is counted, the add_*_penalty functions look them up by name at call time
+# (penalize_barriers_ensemble_exp has its own reference to penalize_barriers_ensemble, so it isn't counted twice)
+def _count_callbacks(penalties, counts):
+    for name in CALLBACKS:
+        func = getattr(penalties, name)
+        def wrapper(*args, _func=func, _name=name):
+            counts[_name] += 1
+            return _func(*args)
+        setattr(penalties, name, wrapper)
+
+def _structure(result):
+    if isinstance(result[0], str):
+        return result[0]
+    return result[0].structure
+
+# Fold one pathway with the notebook loop, timing every length
+def _fold_pathway(func, mode, param, entry, md, backend):
+    last = [] if mode in ENSEMBLE_MODES else ''
+    times = []
+    structures = []
+    for length in entry['lengths']:
+        seq = entry['seq'][:length]
+        start = time.perf_counter()
+        if mode == 'no_constraint':
+            result = func(seq, param, last, md)
+        elif mode == 'shape_constraint':
+            result = func(seq, entry['react'][length], md)
+        else:
+            result = func(seq, param, last, md, backend)
+        times.append(time.perf_counter() - start)
+        last = result if mode in ENSEMBLE_MODES or 'bpp' in mode else result[0]
+        structures.append(_structure(result))
+    return times, structures
+
+# Everything for one (mode, backend), run in its own process
+# With repeat > 1 each length keeps its best time
+def _bench_mode(mode, backend, entries, settings, repeat=1):
+    import penalties
+    from utils import make_md
+
+    rss_start = _peak_rss_mb()
+    counts = Counter()
+    _count_callbacks(penalties, counts)
+    func = getattr(penalties, mode)
+    md = make_md(settings)
+    param = PARAMS.get(mode, 0.5)
+
+    rows = []
+    for name, entry in entries.items():
+        if mode == 'shape_constraint' and entry['react'] is None:
+            continue
+        times = None
+        for _ in range(repeat):
+            # Every repeat has to fold from scratch, anything cached from the last one would just be looked up
+            counts.clear()
+            penalties.BREAKING_CACHE.clear()
+            penalties.SHAPE_CACHE.clear()
+            penalties.use_result_store(None)
+            t, structures = _fold_pathway(func, mode, param, entry, md, backend)
+            times = t if times is None else np.minimum(times, t).tolist()
+        rows.append({
+            'mode' : mode,
+            'backend' : backend,
+            'name' : name,
+            'length' : len(entry['seq']),
+            'seconds' : sum(times),
+            'per_length' : [[l, t] for l, t in zip(entry['lengths'], times)],
+            'callbacks' : sum(counts.values()),
+            'callbacks_by_function' : dict(counts),
+            'pathway_sha1' : hashlib.sha1('\n'.join(structures).encode()).hexdigest()
+        })
+
+    rss_end = _peak_rss_mb()
+    for r in rows:
+        r['peak_rss_mb'] = rss_end
+        r['startup_rss_mb'] = rss_start
+    return rows
+
+def run_benchmark(modes=MODES, backends=['native'], entries=None, temperature=37, repeat=1, progress=True):
+    from utils import md_settings
+    if entries is None:
+        entries = corpus()
+    md = RNA.md()
+    md.temperature = temperature
+    settings = md_settings(md)
+
+    results = []
+    ctx = get_context('spawn') # a clean interpreter per mode, for the RSS numbers
+    for mode in modes:
+        for backend in backends:
+            if mode in ['no_constraint', 'shape_constraint'] and backend != backends[0]:
+                continue # no penalties, the backend doesn't matter
+            start = time.time()
+            with ctx.Pool(1) as pool:
+                rows = pool.apply(_bench_mode, (mode, backend, entries, settings, repeat))
+            results.extend(rows)
+            if progress:
+                print(f"{mode:<40} {backend:<8} {time.time() - start:8.2f}s  {rows[0]['peak_rss_mb'] if rows else 0:7.1f} MB  {sum(r['callbacks'] for r in rows):>12} callbacks", file=sys.stderr)
+
+    return {
+        'meta' : {
+            'date' : time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python' : platform.python_version(),
+            'vienna' : RNA.__version__,
+            'platform' : platform.platform(),
+            'temperature' : temperature,
+            'repeat' : repeat,
+            'params' : PARAMS,
+            'corpus' : {k : {'length' : len(v['seq']), 'lengths' : len(v['lengths'])} for k, v in entries.items()}
+        },
+        'results' : results
+    }
+
+# Compare against a baseline run, returns a list of regressions as strings
+# Total time and peak RSS per (mode, backend) are allowed to grow by tolerance (a fraction),
+# callbacks and pathways have to match exactly
+def compare(results, baseline, tolerance=0.25, min_seconds=0.05):
+    base = {(r['mode'], r['backend'], r['name']) : r for r in baseline['results']}
+    regressions = []
+    totals = {}
+    for r in results['results']:
+        key = (r['mode'], r['backend'], r['name'])
+        if key not in base:
+            continue
+        b = base[key]
+        label = f"{r['mode']} [{r['backend']}] {r['name']}"
+        t = totals.setdefault((r['mode'], r['backend']), {'seconds' : 0, 'base' : 0, 'rss' : r['peak_rss_mb'], 'base_rss' : b['peak_rss_mb']})
+        t['seconds'] += r['seconds']
+        t['base'] += b['seconds']
+        if r['callbacks'] != b['callbacks']:
+            regressions.append(f"{label}: {b['callbacks']} -> {r['callbacks']} callbacks")
+        if r['pathway_sha1'] != b['pathway_sha1']:
+            regressions.append(f"{label}: pathway changed")
+
+    for (mode, backend), t in totals.items():
+        if t['seconds'] > max(t['base'], min_seconds) * (1 + tolerance):
+            regressions.append(f"{mode} [{backend}]: {t['base']:.3f}s -> {t['seconds']:.3f}s")
+        if t['rss'] > t['base_rss'] * (1 + tolerance):
+            regressions.append(f"{mode} [{backend}]: peak RSS {t['base_rss']:.1f} MB -> {t['rss']:.1f} MB")
+    return regressions
+
+# Seconds per mode/backend summed over the corpus, with the speedup against a baseline if there is one
+def summary_table(results, baseline=None):
+    totals = {}
+    for r in results['results']:
+        totals.setdefault((r['mode'], r['backend']), [0, 0])[0] += r['seconds']
+    if baseline is not None:
+        for r in baseline['results']:
+            if (r['mode'], r['backend']) in totals:
+                totals[(r['mode'], r['backend'])][1] += r['seconds']
+
+    lines = []
+    for (mode, backend), (t, b) in totals.items():
+        line = f"{mode:<40} {backend:<8} {t:8.2f}s"
+        if baseline is not None and b > 0:
+            line += f"  (baseline {b:.2f}s, {b / t:.2f}x)"
+        lines.append(line)
+    return '\n'.join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='benchmark', description='Time the folding modes over a fixed RNAstrand/SRP corpus')
+    parser.add_argument('-o', '--output', default='benchmark.json', help='Where to write the results')
+    parser.add_argument('-m', '--modes', nargs='+', default=MODES, help='Folding functions from penalties.py to time')
+    parser.add_argument('-b', '--backends', nargs='+', default=['native'], choices=['native', 'callback'], help='Penalty backends to time')
+    parser.add_argument('--per-bin', type=int, default=PER_BIN, help='RNAstrand records from each length bin')
+    parser.add_argument('--no-srp', action='store_true', help='Leave the SRP construct out of the corpus')
+    parser.add_argument('-T', '--temperature', type=float, default=37, help='Folding temperature')
+    parser.add_argument('-r', '--repeat', type=int, default=1, help='Fold every pathway this many times and keep the best time for each length')
+    parser.add_argument('--compare', default=None, help='Baseline results to check for regressions against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed slowdown/growth as a fraction of the baseline')
+    args = parser.parse_args(argv)
+
+    entries = corpus(per_bin=args.per_bin, srp=not args.no_srp)
+    results = run_benchmark(args.modes, args.backends, entries, args.temperature, args.repeat)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1)
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+    print(summary_table(results, baseline))
+    print(f"Wrote {len(results['results'])} results to {args.output}")
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        for r in regressions:
+            print(f"REGRESSION {r}")
+        if regressions:
+            return 1
+        print(f"No regressions against {args.compare}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
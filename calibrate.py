@@ -0,0 +1,230 @@
+import RNA
+import numpy as np
+import argparse
+import json
+import sys
+import time
+from math import ceil, log
+from multiprocessing import Pool
+from random import choices, seed
+from utils import parse_dp_file, md_settings, make_md, stack_pair_tables, compare_structures, partial_ideal
+from folder import CotranscriptionalFolder, MODES, BPP_MODES, result_structure
+from results import portable
+from sweep import parse_params, shape_pathways
+
+# Penalty calibration by successive halving instead of the notebooks' full grid.
+# Every candidate value starts out folding only the first part of each pathway (a fraction of its lengths),
+# gets scored against the references at those lengths, and only the best 1/eta of them (for any group) go on
+# to the next rung, where the same pathways are extended further.  Only the last rung folds whole pathways.
+# Pathways are carried on from where the last rung stopped rather than refolded, so a value that makes it
+# to the end costs exactly what it would in the grid search and the rest cost a fraction of that.
+#
+# Targets are {name : {'seq', 'lengths', 'refs' : {ref name : {length : db}}}} and groups are {group : [ref names]}.
+# A candidate's score for a group is the mean MCC over the scored lengths, averaged over the group's references
+# and then over the targets, same as the SRP notebook's penalty_sweep rows.
+#     .dp files:    each record is scored against partial_ideal of its reference at every length, one group 'all'
+#     rdat dirs:    the construct is scored against the SHAPE constrained MFE of every replicate and mean,
+#                   grouped by probe (bzcn, dms) plus 'all', like the SRP notebook's best table
+
+# RNA STRAND records, scored against the partial ideal of the reference at each length
+# Lengths where the partial ideal has no pairs at all are left out, their MCC is undefined whatever was predicted
+def dp_targets(dataset, min_length=11):
+    targets = {}
+    for k, v in dataset.items():
+        refs = {}
+        for l in range(min_length, len(v['seq'])+1):
+            ref = ''.join(partial_ideal(v['db'][:l]))
+            if '(' in ref:
+                refs[l] = ref
+        targets[k] = {'seq' : v['seq'], 'lengths' : list(range(min_length, len(v['seq'])+1)), 'refs' : {'db' : refs}}
+    return targets, {'all' : ['db']}
+
+# A construct series from an RdatStore, scored against the SHAPE constrained MFE of each replicate and mean
+def shape_targets(store, md=None, name='rdat', processes=None):
+    data, _ = shape_pathways(store.shape_data(), md, processes, progress=False)
+    refs = {r : {l : v['mfe'] for l, v in d.items()} for r, d in data.items()}
+
+    groups = {}
+    for replicate, probe in zip(store.replicates, store.probes):
+        groups.setdefault(probe.lower(), []).append(replicate)
+    for probe in groups.keys():
+        groups[probe].append('mean_' + probe.upper())
+    groups['all'] = list(refs.keys())
+
+    lengths = store.lengths
+    return {name : {'seq' : store.seq(lengths[-1]), 'lengths' : lengths, 'refs' : refs}}, groups
+
+# Mean MCC of a (partial) pathway against each reference, over the lengths both of them have
+def score_pathway(pathway, refs):
+    scores = {}
+    for r, ref in refs.items():
+        lengths = [l for l in pathway.keys() if l in ref]
+        if len(lengths) == 0:
+            continue
+        width = max(lengths)
+        pred = stack_pair_tables([pathway[l] for l in lengths], width)
+        target = stack_pair_tables([ref[l] for l in lengths], width)
+        scores[r] = float(compare_structures(pred[np.newaxis], target[np.newaxis])['MCC'].mean())
+    return scores
+
+# Score of every group for one candidate, averaged over the targets that have anything scored yet
+def group_scores(pathways, targets, groups):
+    out = {}
+    for g, members in groups.items():
+        per_target = []
+        for k, pathway in pathways.items():
+            scores = score_pathway(pathway, {r : targets[k]['refs'][r] for r in members if r in targets[k]['refs']})
+            if len(scores) > 0:
+                per_target.append(np.mean(list(scores.values())))
+        out[g] = float(np.mean(per_target)) if per_target else -1.0
+    return out
+
+# One piece of one pathway, for the pool
+# state is (length, result) from the end of the last piece, or None to start from scratch
+def _extend(task):
+    i, name, seq, mode, param, lengths, state, settings, backend = task
+    folder = CotranscriptionalFolder(seq, mode, param, lengths=lengths, md=make_md(settings), backend=backend)
+    if state is not None:
+        folder.resume(*state)
+    pathway = {}
+    for length in lengths:
+        result = folder.step(length)
+        pathway[length] = result_structure(result)
+    return i, name, pathway, (lengths[-1], portable(result))
+
+# Fraction of each pathway folded at every rung, the last one is always the whole pathway
+def rung_fractions(n_params, eta=3, min_fraction=None):
+    n_rungs = max(1, ceil(log(max(n_params, 1)) / log(eta)))
+    fractions = [eta**-k for k in range(n_rungs-1, -1, -1)]
+    if min_fraction is not None:
+        fractions = [max(f, min_fraction) for f in fractions]
+    return sorted(set(fractions))
+
+# The keep best of alive by key, values that are still tied after that are picked from the middle of evenly
+# sized runs of them rather than from one end of the grid, they folded the same so far and the later lengths may tell them apart
+def top_values(alive, key, keep):
+    ranked = sorted(alive, key=lambda i: key[i], reverse=True)
+    if len(ranked) <= keep:
+        return ranked
+    cutoff = key[ranked[keep-1]]
+    above = [i for i in ranked if key[i] > cutoff]
+    tied = sorted(i for i in ranked if key[i] == cutoff)
+    n = keep - len(above)
+    return above + [tied[int((j + 0.5) * len(tied) / n)] for j in range(n)]
+
+# Successive halving over params, returns
+#     {'best' : {group : {'pen', 'mcc'}}, 'rungs' : [{'fraction', 'params', 'scores'}], 'folds', 'grid_folds'}
+# best is picked from the values that got full pathways, same as the notebooks' best table
+def successive_halving(targets, groups, mode, params, md=None, eta=3, min_fraction=None, processes=None, backend=None, progress=True):
+    if mode not in MODES or mode in BPP_MODES:
+        raise ValueError(f"Can't calibrate '{mode}', expected one of {[m for m in MODES.keys() if m not in BPP_MODES]}")
+    settings = md_settings(RNA.md() if md is None else md)
+    params = list(params)
+
+    pathways = {i : {k : {} for k in targets.keys()} for i in range(len(params))}
+    states = {i : {k : None for k in targets.keys()} for i in range(len(params))}
+    alive = list(range(len(params)))
+    rungs = []
+    folds = 0
+    start = time.time()
+
+    pool = None if processes == 1 else Pool(processes)
+    try:
+        for fraction in rung_fractions(len(params), eta, min_fraction):
+            tasks = []
+            ends = {k : max(1, ceil(fraction * len(t['lengths']))) for k, t in targets.items()}
+            recent = {k : set(t['lengths'][len(pathways[alive[0]][k]):ends[k]]) for k, t in targets.items()}
+            for i in alive:
+                for k, t in targets.items():
+                    todo = t['lengths'][len(pathways[i][k]):ends[k]]
+                    if len(todo) > 0:
+                        tasks.append((i, k, t['seq'], mode, params[i], todo, states[i][k], settings, backend))
+            # The longest pieces go first so one of them doesn't end up running alone at the end
+            tasks.sort(key=lambda t: -len(t[5]) * t[5][-1]**2)
+            results = map(_extend, tasks) if pool is None else pool.imap_unordered(_extend, tasks)
+            for i, k, pathway, state in results:
+                pathways[i][k].update(pathway)
+                states[i][k] = state
+                folds += len(pathway)
+
+            scores = {i : group_scores(pathways[i], targets, groups) for i in alive}
+            rungs.append({'fraction' : fraction, 'params' : [params[i] for i in alive], 'scores' : {params[i] : scores[i] for i in alive}})
+            if progress:
+                print(f"fraction {fraction:.3f}: {len(alive)} values, {folds} folds, {time.time() - start:.0f}s elapsed", file=sys.stderr)
+
+            # The best 1/eta for any group carry on.  Early rungs only see short prefixes where lots of values
+            # fold the same, so ties are broken by the score over the lengths this rung added
+            last = {i : group_scores({k : {l : s for l, s in p.items() if l in recent[k]} for k, p in pathways[i].items()}, targets, groups) for i in alive}
+            keep = max(1, ceil(len(alive) / eta))
+            survivors = set()
+            for g in groups.keys():
+                survivors.update(top_values(alive, {i : (scores[i][g], last[i][g]) for i in alive}, keep))
+            alive = sorted(survivors)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    final = rungs[-1]['scores']
+    best = {}
+    for g in groups.keys():
+        p = max(final.keys(), key=lambda p: final[p][g])
+        best[g] = {'pen' : p, 'mcc' : final[p][g]}
+
+    return {
+        'best' : best,
+        'rungs' : rungs,
+        'folds' : folds,
+        'grid_folds' : len(params) * sum(len(t['lengths']) for t in targets.values())
+    }
+
+# The notebooks' table of the values that got full pathways, then the best for each group
+def print_best(calibration, file=None):
+    final = calibration['rungs'][-1]['scores']
+    groups = list(calibration['best'].keys())
+    print('Penalty\t' + '\t'.join(groups), file=file)
+    for p, scores in final.items():
+        print(f"{p:.3f}\t" + '\t'.join(f"{scores[g]:.3f}" for g in groups), file=file)
+    print(file=file)
+    print("Best!", file=file)
+    for g, v in calibration['best'].items():
+        print(f"{g}:\tpenalty={v['pen']:.3f} MCC={v['mcc']:.3f}", file=file)
+    print(f"{calibration['folds']} folds instead of {calibration['grid_folds']} for the full grid ({calibration['folds'] / max(calibration['grid_folds'], 1):.0%})", file=file)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='calibrate', description='Find the best penalty for a folding mode by successive halving')
+    parser.add_argument('dataset', help='RNA STRAND .dp file or a directory of rdat files')
+    parser.add_argument('mode', choices=[m for m in MODES.keys() if m not in BPP_MODES], help='Folding function from penalties.py')
+    parser.add_argument('params', type=parse_params, help='Penalty values, either start:stop:step or a comma separated list')
+    parser.add_argument('-o', '--output', default=None, help='Write the rungs and best values to this json file')
+    parser.add_argument('-e', '--eta', type=int, default=3, help='Keep the best 1/eta values at every rung')
+    parser.add_argument('--min-fraction', type=float, default=None, help='Fold at least this fraction of every pathway at the first rung')
+    parser.add_argument('-p', '--processes', type=int, default=None, help='Number of worker processes (default: all cores)')
+    parser.add_argument('-T', '--temperature', type=float, default=37, help='Folding temperature')
+    parser.add_argument('--min-length', type=int, default=11, help='Shortest prefix to fold (.dp only)')
+    parser.add_argument('--max-seq-length', type=int, default=None, help='Only use sequences shorter than this (.dp only)')
+    parser.add_argument('--sample', type=int, default=None, help='Randomly choose this many sequences (.dp only)')
+    parser.add_argument('--seed', type=int, default=1337, help='Seed for --sample')
+    args = parser.parse_args(argv)
+
+    md = RNA.md()
+    md.temperature = args.temperature
+
+    if args.dataset.endswith('.dp'):
+        dataset = parse_dp_file(args.dataset, max_length=None if args.max_seq_length is None else args.max_seq_length - 1)
+        if args.sample is not None:
+            seed(args.seed)
+            dataset = {k : dataset[k] for k in choices(list(dataset.keys()), k=args.sample)}
+        targets, groups = dp_targets(dataset, args.min_length)
+    else:
+        from rdat_store import load_rdat_dir
+        targets, groups = shape_targets(load_rdat_dir(args.dataset), md, processes=args.processes)
+
+    calibration = successive_halving(targets, groups, args.mode, args.params, md, args.eta, args.min_fraction, args.processes)
+    print_best(calibration)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(calibration, f, indent=1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+# What importing the headless core costs a fresh process, against a bare `import RNA, numpy`.
+# Every module is imported in its own interpreter a few times and keeps its fastest run, since the first
+# one or two pay for a cold disk cache.  A pool worker pays this on every spawn, so it has a budget:
+#
+#     python check_startup.py                  core only, fails if it's over budget or loads something heavy
+#     python check_startup.py sweep kinetic    the worker scripts too
+#
+# The budget is on top of the RNA + numpy baseline, which is most of the cost and out of our hands.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Nothing a worker imports should load these, they belong to viz.py / render.py and the notebooks
+HEAVY = ['IPython', 'matplotlib', 'scipy', 'pandas']
+
+BASELINE = 'RNA, numpy'
+MODULES = ['core']
+WORKERS = ['core', 'sweep', 'calibrate', 'kinetic', 'check_subopt', 'shard']
+
+# Extra milliseconds and MB over the baseline
+TIME_BUDGET = 150
+RSS_BUDGET = 20
+
+_PROBE = '''
+import sys, time, json, resource
+start = time.perf_counter()
+import {modules}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds' : seconds, 'rss_mb' : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                  'modules' : len(sys.modules), 'heavy' : [m for m in {heavy!r} if m in sys.modules]}}))
+'''
+
+# One import in a fresh interpreter
+def measure_once(modules):
+    env = dict(os.environ, PYTHONPATH=HERE + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    out = subprocess.run([sys.executable, '-c', _PROBE.format(modules=modules, heavy=HEAVY)],
+                         capture_output=True, text=True, env=env, cwd=HERE)
+    if out.returncode != 0:
+        raise RuntimeError(f"import {modules} failed:\n{out.stderr}")
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+# Best time and RSS over repeat runs
+def measure(modules, repeat=5):
+    runs = [measure_once(modules) for _ in range(repeat)]
+    return {
+        'seconds' : min(r['seconds'] for r in runs),
+        'rss_mb' : min(r['rss_mb'] for r in runs),
+        'modules' : runs[0]['modules'],
+        'heavy' : sorted(set(m for r in runs for m in r['heavy']))
+    }
+
+# Returns (rows, problems), only the modules in checked have to stay within the budget,
+# the rest are reported so it's obvious when a worker script drags something in
+def check(modules=MODULES, checked=MODULES, repeat=5, time_budget=TIME_BUDGET, rss_budget=RSS_BUDGET):
+    base = measure(BASELINE, repeat)
+    rows = [(BASELINE, base)]
+    problems = []
+    for m in modules:
+        r = measure(m, repeat)
+        r['extra_ms'] = (r['seconds'] - base['seconds']) * 1000
+        r['extra_mb'] = r['rss_mb'] - base['rss_mb']
+        rows.append((m, r))
+        if r['heavy']:
+            problems.append(f"{m} loads {', '.join(r['heavy'])}")
+        if m in checked and r['extra_ms'] > time_budget:
+            problems.append(f"{m} takes {r['extra_ms']:.0f} ms over the baseline, the budget is {time_budget} ms")
+        if m in checked and r['extra_mb'] > rss_budget:
+            problems.append(f"{m} uses {r['extra_mb']:.1f} MB over the baseline, the budget is {rss_budget} MB")
+    return rows, problems
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='check_startup', description='Check what importing the headless core costs a fresh process')
+    parser.add_argument('modules', nargs='*', default=None, help=f'Modules to measure (default: {" ".join(MODULES)}, or every worker with --workers)')
+    parser.add_argument('-w', '--workers', action='store_true', help=f'Also measure the scripts that run pools ({", ".join(WORKERS[1:])})')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='Imports per module, the fastest one counts')
+    parser.add_argument('--time-budget', type=float, default=TIME_BUDGET, help='Allowed milliseconds over the RNA + numpy import')
+    parser.add_argument('--rss-budget', type=float, default=RSS_BUDGET, help='Allowed MB of RSS over the RNA + numpy import')
+    args = parser.parse_args(argv)
+
+    modules = args.modules or (WORKERS if args.workers else MODULES)
+    rows, problems = check(modules, modules if args.modules else MODULES, args.repeat, args.time_budget, args.rss_budget)
+
+    print(f"{'import':<16} {'ms':>8} {'MB':>8} {'+ms':>8} {'+MB':>8} {'modules':>8}  heavy")
+    for name, r in rows:
+        extra = f"{r['extra_ms']:8.0f} {r['extra_mb']:8.1f}" if 'extra_ms' in r else f"{'':8} {'':8}"
+        print(f"{name:<16} {r['seconds'] * 1000:8.0f} {r['rss_mb']:8.1f} {extra} {r['modules']:8}  {', '.join(r['heavy'])}")
+
+    for p in problems:
+        print(f"FAILED {p}")
+    return 1 if problems else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,28 +1,12 @@
 import RNA
 import os
 import numpy as np
-from scipy.spatial import distance
-import matplotlib.pyplot as plt
-import argparse
+import json
+import sys
+from utils import design_files, read_design, design_prefix, run_designs
 
 KCAL_TO_KBT = 1.624 # 1kcal/mol = 1.624 kBT @310.15K.
 
-files = os.listdir('.')
-files = [f for f in files if 'design' in f]
-
-md = RNA.md()
-md.temperature = 37
-
-parser = argparse.ArgumentParser()
-parser.add_argument('delta', type=float, help='Window for suboptimal structure prediction (in kBT)')
-args = parser.parse_args()
-
-delta = args.delta #1kBT = 1.023e-21 cal @310.15K.  Vienna is in kcal/mol
-delta = delta * KCAL_TO_KBT # 1kcal/mol = 1.624 kBT @310.15K.
-print(f"{args.delta} KbT = {delta:.3} kcal/mol")
-delta = delta * 100 # subopt input is in dcal/mol
-delta = int(delta) # ViennaRNA input must be an int
-
 #1 kBT -> 2x more likely
 #2 kBT -> 7x more likely
 #3 kBT -> 20x more likely
@@ -30,57 +14,109 @@ delta = int(delta) # ViennaRNA input must be an int
 #5 kBT -> 150x more likely
 #6 kBT -> 403x more likely
 
-for f in files:
-    print(f"Working on {f}")
-    with open(f, 'r') as design:
-        name = design.readline().strip()
-        target = design.readline().strip()
-        seq = design.readline().strip()
-
-    # No pseudoknots in RNAsubopt
-    target = target.replace('[', '.')
-    target = target.replace(']', '.')
+# Energy vs. hamming distance to the target for every suboptimal structure in the window.
+# Both versions return
+#     points    {(distance, energy) : number of structures}
+#     counts    {distance : number of structures}
+#     min_e     {distance : lowest energy}
+# Energies are rounded to 0.01 kcal/mol, which is Vienna's resolution anyway.
 
+# Streams the structures through subopt_cb and only keeps the histograms,
+# so memory is bounded by the number of distinct distances (and energies within the window) rather than the number of structures
+def landscape(seq, target, delta, md):
+    fc = RNA.fold_compound(seq, md)
+    target = np.frombuffer(target.encode(), dtype=np.uint8)
+    data = {'points' : {}, 'counts' : {}, 'min_e' : {}}
+
+    def collect(structure, energy, data):
+        if structure is None: # subopt_cb signals the end with an empty structure
+            return
+        d = int(np.count_nonzero(np.frombuffer(structure.encode(), dtype=np.uint8) != target))
+        e = round(energy, 2)
+        data['points'][(d, e)] = data['points'].get((d, e), 0) + 1
+        data['counts'][d] = data['counts'].get(d, 0) + 1
+        if e < data['min_e'].get(d, np.inf):
+            data['min_e'][d] = e
+
+    fc.subopt_cb(delta, collect, data)
+    return data['points'], data['counts'], data['min_e']
+
+# The original version, keeps every structure in memory
+def landscape_full(seq, target, delta, md):
+    from scipy.spatial import distance
     fc = RNA.fold_compound(seq, md)
 
-    competing = fc.subopt(delta) 
-
-    print(f"Identified {len(competing)} structures.")
+    competing = fc.subopt(delta)
 
     distances = np.array([int(np.round(distance.hamming(list(target), list(c.structure)) * len(target))) for c in competing])
-    energies = np.array([c.energy for c in competing])
+    energies = np.array([round(c.energy, 2) for c in competing])
 
-    # minimum energy for each distance ended up really noisy because the good structures are evenly spaced 2 apart.
-    # get the minimum of each pair and use that.
-    distance_values = list(set(distances))
+    points = {}
+    for d, e in zip(distances.tolist(), energies.tolist()):
+        points[(d, e)] = points.get((d, e), 0) + 1
+
+    distance_values = list(set(distances.tolist()))
     distance_values.sort()
-    min_energies = np.empty_like(distance_values)
-    min_energies.dtype = float 
-    for i, d in enumerate(distance_values):
+    counts = {}
+    min_e = {}
+    for d in distance_values:
         distance_mask = distances==d
-        min_energies[i] = min(energies[distance_mask])
-
-    lineX = []
-    lineY = []
-    for d, m in zip(zip(*[iter(distance_values)]*2), zip(*[iter(min_energies)]*2)): #that's pythonic, apparently.
-        min_idx = min(range(len(m)), key=m.__getitem__)
-        lineX.append(d[min_idx])
-        lineY.append(m[min_idx])
-
-
-    # Plot all the distance/energy pairs and put a bounding line on the min energies.
-    fig, ax = plt.subplots()
-    ax.scatter(distances, energies, alpha = 0.1)
-    ax.plot(lineX, lineY, 'b--')
-    ax.set_ylabel('Free energy (kcal/mol)')
-    ax.set_xlabel('Hamming distance')
-    ax.set_xticks(np.arange(min(distances), max(distances)+1, 1))
-    plt.tight_layout()
-    plt.savefig(f.strip('design.txt')+'ensemble.png', dpi = 200)
-
-    ## pick the structure with the furthest distance and perform a tree search looking for the target structure.
-    #max_distance = max(distances)
-    #distance_mask = distances==max_distance
-
-
-     
\ No newline at end of file
+        counts[d] = int(np.sum(distance_mask))
+        min_e[d] = float(min(energies[distance_mask]))
+
+    return points, counts, min_e
+
+# kBT window from the command line to the dcal/mol subopt wants
+def kbt_to_delta(kbt):
+    delta = kbt #1kBT = 1.023e-21 cal @310.15K.  Vienna is in kcal/mol
+    delta = delta * KCAL_TO_KBT # 1kcal/mol = 1.624 kBT @310.15K.
+    delta = delta * 100 # subopt input is in dcal/mol
+    return int(delta) # ViennaRNA input must be an int
+
+# One design file for utils.run_designs
+# Writes the <prefix>ensemble.json record that render.py draws the plot from
+def _run_design(f, out_dir, settings):
+    name, target, seq = read_design(f)
+    md = RNA.md()
+    md.temperature = settings['temperature']
+
+    if settings['full']:
+        points, counts, min_e = landscape_full(seq, target, settings['delta'], md)
+    else:
+        points, counts, min_e = landscape(seq, target, settings['delta'], md)
+
+    record = design_prefix(f, out_dir)+'ensemble.json'
+    with open(record, 'w') as out:
+        json.dump({
+            'kind' : 'ensemble', 'name' : name, 'seq' : seq, 'target' : target, 'delta' : settings['delta'],
+            'points' : [[d, e, n] for (d, e), n in points.items()],
+            'counts' : [[d, n] for d, n in counts.items()],
+            'min_e' : [[d, e] for d, e in min_e.items()]
+        }, out)
+
+    return {'length' : len(seq), 'structures' : sum(counts.values()), 'distances' : len(counts)}, record
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog='subopt-landscape', description='Energy vs. distance to the target for the suboptimal ensemble of design files')
+    parser.add_argument('delta', type=float, help='Window for suboptimal structure prediction (in kBT)')
+    parser.add_argument('inputs', nargs='*', default=['.'], help="Design files, globs or directories (directories are searched for files with 'design' in the name, default: .)")
+    parser.add_argument('-o', '--output-dir', default='.', help='Where to write the per-design results and plots')
+    parser.add_argument('-T', '--temperature', type=float, default=37, help='Folding temperature')
+    parser.add_argument('-p', '--processes', type=int, default=None, help='Number of worker processes (default: all cores)')
+    parser.add_argument('--full', action='store_true', help='Keep every suboptimal structure in memory like the original version')
+    parser.add_argument('--no-render', action='store_true', help='Only write the result records, plot them later with render.py')
+    args = parser.parse_args(argv)
+
+    files = design_files(args.inputs)
+    if len(files) == 0:
+        parser.error('no design files found')
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    delta = kbt_to_delta(args.delta)
+    print(f"{args.delta} KbT = {delta / 100:.3} kcal/mol")
+    settings = {'temperature' : args.temperature, 'delta' : delta, 'full' : args.full}
+    return run_designs(files, _run_design, args.output_dir, settings, ['length', 'structures', 'distances'], args.processes, not args.no_render)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,20 @@
+# The headless part of the package in one import: folding, penalties, parsing and metrics.
+# Nothing under here pulls in more than RNA, numpy and the standard library, so a pool worker
+# that does `from core import ...` starts about as fast as one that only imports RNA.
+# The notebook and plotting helpers live in viz.py and render.py and are only loaded when asked for.
+# check_startup.py measures what importing this costs and fails if anything heavy sneaks back in.
+#
+#     from core import CotranscriptionalFolder, parse_dp_file, compare_structures
+
+from utils import (md_settings, make_md, pair_table, as_pair_table, dot_bracket, partial_ideal, calc_MCC,
+                   stack_pair_tables, stack_pathways, compare_structures, structure_matrix, hamming_distances,
+                   bp_distances, dict_dot_bracket, list_dot_bracket, parse_rdat, parse_drt_file, iter_dp_file,
+                   read_dp_record, parse_dp_file, PAD)
+from penalties import (no_constraint, shape_constraint, constant_penalty, sequence_dependent_penalty,
+                       constant_ensemble_penalty, sequence_dependent_ensemble_penalty, constant_bpp_penalty,
+                       sequence_dependent_bpp_penalty, add_constant_penalty, add_sequence_dependent_penalty,
+                       add_ensemble_penalty, add_penalty_matrix, get_penalties, pairing_frequency,
+                       shape_reactivities, use_result_store)
+from folder import CotranscriptionalFolder, MODES, result_structure
+from pathway import FoldingPathway, compare_all, pathways_from_dicts
+from results import ResultStore
@@ -0,0 +1,297 @@
+import RNA
+import time
+import numpy as np
+import penalties
+import instrument
+from utils import pair_table, stack_pair_tables, bp_distances
+from penalties import (no_constraint, constant_penalty, sequence_dependent_penalty,
+                       constant_ensemble_penalty, sequence_dependent_ensemble_penalty,
+                       constant_bpp_penalty, sequence_dependent_bpp_penalty,
+                       add_constant_penalty, add_sequence_dependent_penalty, add_ensemble_penalty,
+                       get_penalties, pairing_frequency, SparsePenalties,
+                       window_fold, shift_pair_table, window_penalties, stored_name, WINDOW_STATS)
+
+# The folding functions the folder knows how to step, by name.
+MODES = {
+    'no_constraint' : no_constraint,
+    'constant_penalty' : constant_penalty,
+    'sequence_dependent_penalty' : sequence_dependent_penalty,
+    'constant_ensemble_penalty' : constant_ensemble_penalty,
+    'sequence_dependent_ensemble_penalty' : sequence_dependent_ensemble_penalty,
+    'constant_bpp_penalty' : constant_bpp_penalty,
+    'sequence_dependent_bpp_penalty' : sequence_dependent_bpp_penalty
+}
+
+ENSEMBLE_MODES = ['constant_ensemble_penalty', 'sequence_dependent_ensemble_penalty']
+
+# The partition function modes carry their own pairing frequencies from step to step
+BPP_MODES = ['constant_bpp_penalty', 'sequence_dependent_bpp_penalty']
+
+# Modes that draw a Boltzmann sample, they take a seed (see penalties.sequence_dependent_bpp_penalty)
+SAMPLED_MODES = ['sequence_dependent_bpp_penalty']
+
+# Modes that can refold just a 3' window, which approximates the full refold (see penalties.window_fold)
+WINDOW_MODES = ['constant_penalty', 'sequence_dependent_penalty']
+
+# Modes whose whole state is the last MFE structure, so skipped lengths can be filled in (see run_adaptive)
+ADAPTIVE_MODES = ['no_constraint', 'constant_penalty', 'sequence_dependent_penalty']
+
+# Pull the MFE structure out of whatever a folding function returned
+# mfe returns (structure, energy), subopt returns a list of subopt objects
+def result_structure(result):
+    if isinstance(result[0], str):
+        return result[0]
+    return result[0].structure
+
+# structure is last with unpaired nucleotides added on the end
+def extends(structure, last):
+    return structure.startswith(last) and structure.count('.', len(last)) == len(structure) - len(last)
+
+# Fold a transcript co-transcriptionally, one prefix length at a time.
+# This is the loop from the notebooks:
+#     last = '' (or [])
+#     for length in lengths:
+#         last = func(seq[:length], penalty, last, md)
+# but the fold compound, parsed pair table and penalty table from each step are kept for the next one.
+# In particular the fold compound for the last prefix is reused for the eval_move calls
+# instead of building a second one every step.
+#
+# Iterating yields (length, result) where result is whatever the matching folding function returns.
+# With window set the MFE penalty modes only refold the last window nt of each prefix when they can,
+# which is faster on long transcripts but doesn't always give the full refold's pathway (see window_agreement).
+# seed is passed on to the SAMPLED_MODES, which are only reproducible (and stored) with one.
+# Steps go through penalties.RESULT_STORE when one is set, same as calling the folding functions directly.
+class CotranscriptionalFolder:
+    def __init__(self, seq, mode='sequence_dependent_penalty', penalty=0, start=10, step=1, lengths=None, md=None, backend=None, window=None, seed=None):
+        if callable(mode):
+            mode = mode.__name__
+        if mode not in MODES:
+            raise ValueError(f"Unknown folding mode '{mode}', expected one of {list(MODES.keys())}")
+        if window is not None and mode not in WINDOW_MODES:
+            raise ValueError(f"Only {WINDOW_MODES} can be folded in a window, not '{mode}'")
+
+        self.seq = seq
+        self.mode = mode
+        self.penalty = penalty
+        self.md = RNA.md() if md is None else md
+        self.backend = backend
+        self.window = window
+        self.seed = seed
+        if lengths is None:
+            lengths = range(start, len(seq)+1, step)
+        self.lengths = [int(l) for l in lengths]
+
+        self.reset()
+
+    # Forget everything from the last pathway
+    def reset(self):
+        self.last = [] if self.mode in ENSEMBLE_MODES else ''
+        self.last_pt = pair_table('')
+        self.last_fc = None
+        self.last_seq = ''
+        self.penalties = np.zeros(1, dtype=np.int32)
+        self.freqs = SparsePenalties() # refilled in place at every step of the ensemble modes
+
+    def __iter__(self):
+        self.reset()
+        for length in self.lengths:
+            yield length, self.step(length)
+
+    # Run the whole pathway and return {length : mfe structure} like the notebooks build
+    def run(self):
+        return {length : result_structure(result) for length, result in self}
+
+    # Same as run, but strides over the lengths where nothing happens. Returns ({length : mfe structure}, number of folds)
+    # Most steps just add unpaired nucleotides to the last structure. While that keeps happening the stride doubles
+    # (up to max_stride lengths) and the lengths that were jumped over get the last structure plus an unpaired tail,
+    # which is what folding them would have given. When a stride comes back with a different structure it's thrown away
+    # and the interval is bisected from the same state down to the first length that changes,
+    # so every rearrangement is still found at the length it happens.
+    # A rearrangement that forms and is undone again inside one stride is missed, max_stride=1 is the same as run().
+    def run_adaptive(self, max_stride=8):
+        if self.mode not in ADAPTIVE_MODES:
+            raise ValueError(f"Only {ADAPTIVE_MODES} can be stepped adaptively, not '{self.mode}'")
+        self.reset()
+        lengths = self.lengths
+        pathway = {lengths[0] : result_structure(self.step(lengths[0]))}
+        folds = 1
+        i = 0
+        stride = 1
+        changed = None # index of a length that came back changed, the rearrangement is somewhere in (i, changed]
+        while i < len(lengths) - 1:
+            if changed is None:
+                j = min(i + stride, len(lengths) - 1)
+            else:
+                j = (i + changed + 1) // 2
+            state = self._checkpoint()
+            structure = result_structure(self.step(lengths[j]))
+            folds += 1
+            last = pathway[lengths[i]]
+            if extends(structure, last):
+                for length in lengths[i+1:j+1]:
+                    pathway[length] = last + '.' * (length - lengths[i])
+                if changed is None:
+                    stride = min(stride * 2, max_stride)
+                elif changed == j:
+                    changed = None # it was only different from the older state
+                i = j
+            elif j == i + 1:
+                pathway[lengths[j]] = structure
+                i = j
+                stride = 1
+                changed = None
+            else:
+                self._restore(state)
+                changed = j
+        return pathway, folds
+
+    # Carry on from the result a pathway got to at length, e.g. one folded in another process
+    # (the ensemble modes take a results.portable subopt list)
+    def resume(self, length, result):
+        self.reset()
+        if self.mode in BPP_MODES:
+            self.last = result
+            return
+        self.last_seq = self.seq[:length]
+        self._update(result)
+
+    # Everything step() changes, so a step can be taken back
+    def _checkpoint(self):
+        return (self.last, self.last_pt, self.last_fc, self.last_seq, self.penalties)
+
+    def _restore(self, state):
+        self.last, self.last_pt, self.last_fc, self.last_seq, self.penalties = state
+
+    # Fold the next prefix given the state left over from the last step
+    def step(self, length):
+        subseq = self.seq[:length]
+        if self.mode in SAMPLED_MODES:
+            self.last = MODES[self.mode](subseq, self.penalty, self.last, self.md, self.backend, self.seed)
+            return self.last
+        if self.mode in BPP_MODES:
+            self.last = MODES[self.mode](subseq, self.penalty, self.last, self.md, self.backend)
+            return self.last
+
+        store = penalties.RESULT_STORE
+        if store is not None:
+            if self.mode == 'no_constraint':
+                key = store.key(self.mode, subseq, 0, '', self.md)
+            else:
+                key = store.key(stored_name(self.mode, self.window), subseq, self.penalty, self.last, self.md)
+            result = store.get(key)
+            if result is not None:
+                # No fold compound this time, one gets made if the next step needs it
+                self.last_fc = None
+                self.last_seq = subseq
+                self._update(result)
+                return result
+
+        if self.window is not None and self.last != '':
+            result = window_fold(subseq, self.last, self.last_pt, self.window, self._penalize_window, self.md)
+            if result is not None:
+                self.last_fc = None
+                self.last_seq = subseq
+                self._update(result)
+                if store is not None:
+                    store.put(key, result)
+                return result
+
+        fc = RNA.fold_compound(subseq, self.md)
+        if self.mode in ENSEMBLE_MODES:
+            freqs = self._ensemble_freqs(length)
+
+        with instrument.phase('add_penalties', length=length):
+            if self.mode == 'constant_penalty':
+                add_constant_penalty(fc, self.penalty, self.last_pt, self.backend)
+            elif self.mode == 'sequence_dependent_penalty':
+                add_sequence_dependent_penalty(fc, self.penalty, self.last_pt, self.penalties, self.backend)
+            elif self.mode in ENSEMBLE_MODES:
+                add_ensemble_penalty(fc, freqs, self._ensemble_penalty(), self.backend)
+
+        if self.mode in ENSEMBLE_MODES:
+            with instrument.phase('subopt', length=length):
+                result = fc.subopt(500)
+            instrument.record('subopt_size', len(result), length=length)
+        else:
+            with instrument.phase('mfe', length=length):
+                result = fc.mfe()
+
+        # The penalties are only needed for this fold.
+        # Without them this is a plain fold compound for the prefix, which is what eval_move needs next step.
+        fc.sc_remove()
+        self.last_fc = fc
+        self.last_seq = subseq
+        self._update(result)
+        if store is not None:
+            store.put(key, result)
+
+        return result
+
+    # Attach this step's penalties to the fold compound for the window starting at offset
+    def _penalize_window(self, fc, offset):
+        if self.mode == 'constant_penalty':
+            add_constant_penalty(fc, self.penalty, shift_pair_table(self.last_pt, offset), self.backend)
+        else:
+            add_sequence_dependent_penalty(fc, self.penalty, shift_pair_table(self.last_pt, offset), window_penalties(self.penalties, offset), self.backend)
+
+    # Plain fold compound for the last prefix
+    def _last_fc(self):
+        if self.last_fc is None:
+            self.last_fc = RNA.fold_compound(self.last_seq, self.md)
+        return self.last_fc
+
+    def _ensemble_penalty(self):
+        if self.mode == 'constant_ensemble_penalty':
+            return int(self.penalty)
+        return self.penalty
+
+    def _ensemble_freqs(self, length):
+        if self.last != []:
+            last_fc = self._last_fc() if self.mode == 'sequence_dependent_ensemble_penalty' else None
+            with instrument.phase('pairing_frequency', length=length):
+                pairing_frequency(self.last, last_fc, out=self.freqs)
+        self.freqs.resize(length)
+        return self.freqs
+
+    # Parse the result once and pre-compute whatever the next step's penalties need
+    def _update(self, result):
+        if self.mode in ENSEMBLE_MODES:
+            self.last = result
+            return
+
+        self.last = result[0]
+        self.last_pt = pair_table(self.last)
+        if self.mode == 'sequence_dependent_penalty':
+            with instrument.phase('get_penalties', length=len(self.last)):
+                self.penalties = get_penalties(self.last, self._last_fc())
+
+# How closely windowed refolding follows full refolding for one transcript
+# Both pathways are folded from scratch, so differences compound along the pathway the same way they would in a sweep
+def window_agreement(seq, mode, penalty, window, start=10, step=1, lengths=None, md=None, backend=None):
+    WINDOW_STATS.clear()
+    t = time.time()
+    full = CotranscriptionalFolder(seq, mode, penalty, start, step, lengths, md, backend).run()
+    full_seconds = time.time() - t
+    t = time.time()
+    windowed = CotranscriptionalFolder(seq, mode, penalty, start, step, lengths, md, backend, window).run()
+    window_seconds = time.time() - t
+
+    lengths = list(full.keys())
+    distance = np.array([bp_distances(stack_pair_tables([windowed[l]]), pair_table(full[l]))[0] for l in lengths])
+    disagree = [l for l, d in zip(lengths, distance) if d > 0]
+
+    return {
+        'steps' : len(lengths),
+        'windowed' : WINDOW_STATS['windowed'],
+        'boundary_fallbacks' : WINDOW_STATS['boundary'],
+        'crossing_fallbacks' : WINDOW_STATS['crossing'],
+        'full_refolds' : WINDOW_STATS['no_window'] + WINDOW_STATS['boundary'] + WINDOW_STATS['crossing'],
+        'agreement' : 1 - len(disagree) / len(lengths),
+        'mean_bp_distance' : float(distance.mean()),
+        'max_bp_distance' : int(distance.max()),
+        'final_bp_distance' : int(distance[-1]),
+        'first_disagreement' : disagree[0] if disagree else None,
+        'full_seconds' : full_seconds,
+        'window_seconds' : window_seconds,
+        'speedup' : full_seconds / window_seconds
+    }
@@ -0,0 +1,139 @@
+import os
+import json
+import time
+from collections import Counter
+from contextlib import nullcontext
+import RNA
+
+# Opt-in instrumentation for the folding hot path.
+#     instrument.enable()
+#     ... fold things ...
+#     instrument.export('run.json')           summary: time per phase and per prefix length, callback counts, subopt sizes
+#     instrument.export('run.trace.json')     the same events as a Chrome trace (chrome://tracing or ui.perfetto.dev)
+#
+# Code being measured wraps each phase in
+#     with instrument.phase('mfe', length=len(seq)):
+# and registers its soft constraint callbacks through
+#     fc.sc_add_f(instrument.callback(penalize_barriers))
+# While disabled phase() hands back one shared null context and callback() returns the function untouched,
+# so nothing extra runs inside Vienna's callbacks and the cost per phase is a function call.
+# Setting KINETIC_INSTRUMENT=1 in the environment turns it on at import.
+
+ENABLED = False
+
+EVENTS = []    # (name, start, duration, args)
+CALLBACKS = {} # callback name -> Counter of decomposition type
+VALUES = {}    # name -> [(value, time, args)], for things like subopt list sizes
+_WRAPPED = {}
+_NULL = nullcontext()
+_T0 = time.perf_counter()
+
+# RNA.DECOMP_PAIR_HP etc. back to their names
+DECOMP_NAMES = {getattr(RNA, k) : k[len('DECOMP_'):] for k in dir(RNA) if k.startswith('DECOMP_')}
+# The decompositions the penalty callbacks actually act on
+PAIR_DECOMPS = ['PAIR_HP', 'PAIR_IL', 'PAIR_ML']
+
+def enable():
+    global ENABLED
+    ENABLED = True
+
+def disable():
+    global ENABLED
+    ENABLED = False
+
+# Throw away everything recorded so far
+def reset():
+    global _T0
+    EVENTS.clear()
+    VALUES.clear()
+    for counts in CALLBACKS.values():
+        counts.clear() # the wrappers hold on to these
+    _T0 = time.perf_counter()
+
+class _Phase:
+    __slots__ = ('name', 'args', 'start')
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        EVENTS.append((self.name, self.start, time.perf_counter() - self.start, self.args))
+
+# Time a block, args (like length=...) are kept with the event
+def phase(name, **args):
+    if not ENABLED:
+        return _NULL
+    return _Phase(name, args)
+
+# Soft constraint callback that counts its calls by decomposition type
+def callback(func):
+    if not ENABLED:
+        return func
+    wrapped = _WRAPPED.get(func)
+    if wrapped is None:
+        counts = CALLBACKS.setdefault(func.__name__, Counter())
+        def wrapped(i, j, k, l, d, data):
+            counts[d] += 1
+            return func(i, j, k, l, d, data)
+        _WRAPPED[func] = wrapped
+    return wrapped
+
+# Record a value, like the size of a subopt list
+def record(name, value, **args):
+    if ENABLED:
+        VALUES.setdefault(name, []).append((value, time.perf_counter(), args))
+
+def summary():
+    phases = {}
+    per_length = {}
+    for name, start, duration, args in EVENTS:
+        p = phases.setdefault(name, {'count' : 0, 'seconds' : 0.0, 'max' : 0.0})
+        p['count'] += 1
+        p['seconds'] += duration
+        p['max'] = max(p['max'], duration)
+        if 'length' in args:
+            l = per_length.setdefault(args['length'], {})
+            l[name] = l.get(name, 0.0) + duration
+    for p in phases.values():
+        p['mean'] = p['seconds'] / p['count']
+
+    callbacks = {}
+    for func, counts in CALLBACKS.items():
+        by_type = {DECOMP_NAMES.get(d, str(d)) : n for d, n in sorted(counts.items())}
+        pair = sum(n for t, n in by_type.items() if t in PAIR_DECOMPS)
+        callbacks[func] = {'total' : sum(by_type.values()), 'pair' : pair, 'other' : sum(by_type.values()) - pair, 'by_type' : by_type}
+
+    values = {}
+    for name, vs in VALUES.items():
+        v = [x for x, _, _ in vs]
+        values[name] = {'count' : len(v), 'total' : sum(v), 'min' : min(v), 'max' : max(v), 'mean' : sum(v) / len(v),
+                        'per_length' : {a['length'] : x for x, _, a in vs if 'length' in a}}
+
+    return {'phases' : phases, 'per_length' : {k : per_length[k] for k in sorted(per_length)}, 'callbacks' : callbacks, 'values' : values}
+
+# Events as a Chrome trace, values become counter tracks
+def chrome_trace():
+    pid = os.getpid()
+    events = [{'name' : name, 'ph' : 'X', 'ts' : (start - _T0) * 1e6, 'dur' : duration * 1e6, 'pid' : pid, 'tid' : 0, 'args' : args}
+              for name, start, duration, args in EVENTS]
+    for name, vs in VALUES.items():
+        for value, t, args in vs:
+            events.append({'name' : name, 'ph' : 'C', 'ts' : (t - _T0) * 1e6, 'pid' : pid, 'tid' : 0, 'args' : {name : value}})
+    end = max([e['ts'] + e.get('dur', 0) for e in events], default=0)
+    events.append({'name' : 'callbacks', 'ph' : 'i', 's' : 'p', 'ts' : end, 'pid' : pid, 'tid' : 0, 'args' : summary()['callbacks']})
+    return {'traceEvents' : events, 'displayTimeUnit' : 'ms'}
+
+# Write the summary, or a Chrome trace if the filename ends in .trace.json (or format='chrome')
+def export(filename, format=None):
+    if format is None:
+        format = 'chrome' if filename.endswith('.trace.json') else 'json'
+    with open(filename, 'w') as f:
+        json.dump(chrome_trace() if format == 'chrome' else summary(), f)
+
+if os.environ.get('KINETIC_INSTRUMENT', '') not in ['', '0']:
+    enable()
@@ -1,188 +1,126 @@
 import RNA
 import os
 import numpy as np
-from scipy.spatial import distance
-import matplotlib.pyplot as plt
-import argparse
-from utils import dict_dot_bracket
-
-# If something in the full seq is paired to something which doesn't exist in the subseq
-# Then I don't think it counts as a missfold if that nucleotide is unpaired in the subseq fold
-def partial_ideal(ref):
-    # First we identify unclosed opening brackets
-    ref_transformed = []
-    pstack = []
-    for i, c in enumerate(ref):
-        ref_transformed.append(c)
-        if c == '(':
-            pstack.append(i)
-        if c == ')':
-            pstack.pop()
-
-    # And pretend those are unpaired.
-    for i in pstack:
-        ref_transformed[i] = '.'
-    
-    return(ref_transformed)
-
-
-
-# Energy correction which penalizes base pairs which were not present in the last iteration
-# The penalty is equal to ...% of the dinucleotide step which needs to be broken
-# Cody suggests 1.5-2.5 kcal
-def penalize_barriers(i, j, k, l, d, arg_dict):
-    penalty = 500 # WHAT SHOULD THIS BE???
-    if d in [RNA.DECOMP_PAIR_IL, RNA.DECOMP_PAIR_HP, RNA.DECOMP_PAIR_ML]:
-        ref = arg_dict['last']
-        if i in ref.keys():
-            if ref[i] == j:
-                return 0
-            else:
-                return penalty
-            
-    return 0
-        
-
-files = os.listdir('.')
-files = [f for f in files if 'design' in f]
-
-md = RNA.md()
-md.temperature = 37
-
-for f in files:
-    with open(f, 'r') as design:
-        name = design.readline().strip()
-        target = design.readline().strip()
-        seq = design.readline().strip()
-
-    # No pseudoknots in RNAsubopt
-    target = target.replace('[', '.')
-    target = target.replace(']', '.')
-
-    # Create subsequences, each 10 nt longer than the last.  Fold.
-    # Then compare the distance between the fold of the subseq to the truncated fold of the whole structure.
-    # This tries both a fresh fold of the whole subsequence, as well as a fold with soft constraints based on the MFE of the last iteration.
-    step_size = 10
+import json
+import sys
+import instrument
+from penalties import add_constant_penalty
+from utils import (pair_table, partial_ideal, structure_matrix, hamming_distances, stack_pair_tables, bp_distances,
+                   design_files, read_design, design_prefix, run_designs)
+
+# Distances from a whole subopt ensemble to the reference in one go
+# The structures are stacked once as characters (for hamming distance) and as pair tables (for base pair distance)
+def ensemble_distances(competing, ref, ref_pt):
+    energies = np.array([c.energy for c in competing])
+    structures = [c.structure for c in competing]
+    min_idx = int(np.argmin(energies))
+
+    hamming = hamming_distances(structure_matrix(structures), ref)
+    bp = bp_distances(stack_pair_tables(structures), ref_pt)
+
+    return {
+        'mfe' : structures[min_idx],
+        'min' : int(hamming.min()),
+        'max' : int(hamming.max()),
+        'median' : float(np.median(hamming)),
+        'mfe_dist' : int(hamming[min_idx]),
+        'mfe_bp' : int(bp[min_idx]),
+        'n' : len(structures)
+    }
+
+# Create subsequences, each step nt longer than the last.  Fold.
+# Then compare the distance between the fold of the subseq to the truncated fold of the whole structure.
+# This tries both a fresh fold of the whole subsequence, as well as a fold with soft constraints based on the MFE of the last iteration.
+# window is the subopt window in dcal/mol
+# The constrained fold penalizes pairs that weren't in the last step's MFE with penalties.add_constant_penalty
+# (a WHAT SHOULD THIS BE??? 500 by default, Cody suggests 1.5-2.5 kcal), backend picks native or callback like everywhere else
+# Returns one record per length:
+#     {'length', 'comp' : ensemble_distances of the complete fold, 'con' : same for the constrained fold, 'mfe_diff'}
+def fold_design(seq, target, md, step_size=10, window=100, penalty=500, verbose=False, backend=None):
     boundspace = np.arange(10, len(seq)+step_size, step_size)
+    steps = []
+    last_structure = pair_table('')
 
-    mins_comp = np.empty_like(boundspace)
-    maxes_comp = np.empty_like(boundspace)
-    meds_comp = np.empty_like(boundspace)
-    mfes_comp = np.empty_like(boundspace)
-    n_sub_comp = np.empty_like(boundspace)
-    mins_con = np.empty_like(boundspace)
-    maxes_con = np.empty_like(boundspace)
-    meds_con = np.empty_like(boundspace)
-    mfes_con = np.empty_like(boundspace)
-    n_sub_con = np.empty_like(boundspace)
-    mfe_diff = np.empty_like(boundspace)
-    last_structure = {}
-
-    for i, bound in enumerate(boundspace):
+    for bound in boundspace.tolist():
         subseq = seq[:bound]
         subtarget = target[:bound]
         ref = partial_ideal(subtarget)
+        ref_pt = stack_pair_tables([''.join(ref)])[0]
 
         ###################################
         #          complete fold          #
         ###################################
         fc = RNA.fold_compound(subseq, md)
-        competing = fc.subopt(100)
-        
-        energies = [c.energy for c in competing]
-        structures = [c.structure for c in competing]
-        distances = [int(np.round(distance.hamming(list(s), ref) * len(ref))) for s in structures]
-        min_idx = np.argmin(energies)
-        mfe_comp = structures[min_idx]
-
-        mins_comp[i] = min(distances)
-        maxes_comp[i] = max(distances)
-        meds_comp[i] = np.median(distances)
-        mfes_comp[i] = distances[min_idx]
-        n_sub_comp[i] = len(competing)
+        with instrument.phase('subopt_complete', length=bound):
+            competing = fc.subopt(window)
+        instrument.record('subopt_size_complete', len(competing), length=bound)
+
+        with instrument.phase('distances', length=bound):
+            comp = ensemble_distances(competing, ref, ref_pt)
 
         ###################################
         #         constrained fold        #
         ###################################
         fc = RNA.fold_compound(subseq, md)
-
-        step_info = {
-            'last' : last_structure
-        }
-
-        fc.sc_add_f(penalize_barriers)
-        fc.sc_add_data(step_info)
-
-        competing = fc.subopt(100)
-
-        distances = [int(np.round(distance.hamming(list(c.structure), ref) * len(ref))) for c in competing]
-        energies = [c.energy for c in competing]
-        structures = [c.structure for c in competing]
-
-        min_idx = np.argmin(energies)
-        mfe_con = structures[min_idx]
-        last_structure = dict_dot_bracket(mfe_con)
-
-        mins_con[i] = min(distances)
-        maxes_con[i] = max(distances)
-        meds_con[i] = np.median(distances)
-        mfes_con[i] = distances[min_idx]
-        n_sub_con[i] = len(competing)
-
-
-        mfe_diff[i] = int(np.round(distance.hamming(list(mfe_comp), list(mfe_con)) * len(mfe_con)))
-        print(f"Curr_length: {len(subseq)}, Comp_subs: {n_sub_comp[i]}, Con_subs: {n_sub_con[i]}, MFE_dist: {mfe_diff[i]}")
-
-
-    # let's plot the min, med and max and see that path to the final structure.
-    fig, ax = plt.subplots(1, 2, figsize=(10, 5))
-    a02 = ax[0].twinx()
-    ln1 = a02.plot(boundspace, n_sub_comp, 'r--', label='n structures')
-    ln2 = ax[0].plot(boundspace, maxes_comp, label='max dist', c='deepskyblue')
-    ln3 = ax[0].plot(boundspace, meds_comp, label='median dist', c='royalblue')
-    ln4 = ax[0].plot(boundspace, mfes_comp, label='mfe dist', c='g')
-    ln5 = ax[0].plot(boundspace, mins_comp, label='min dist', c='darkblue')
-    ax[0].set_title("Complete fold")
-    ax[0].set_xlabel("subsequence length")
-
-    lines = ln1 + ln2 + ln3 + ln4 + ln5
-    labs = [l.get_label() for l in lines]
-    ax[0].legend(lines, labs)
-
-    a12 = ax[1].twinx()
-    ln1 = a12.plot(boundspace, n_sub_con, 'r--', label='n structures')
-    ln2 = ax[1].plot(boundspace, maxes_con, label='max dist', c='deepskyblue')
-    ln3 = ax[1].plot(boundspace, meds_con, label='median dist', c='royalblue')
-    ln4 = ax[1].plot(boundspace, mfes_con, label='mfe dist', c='g')
-    ln5 = ax[1].plot(boundspace, mins_con, label='min dist', c='darkblue')
-    ax[1].set_xlabel("Subsequence length")
-    ax[1].set_title("Constrained fold")
-
-    #lines = ln1 + ln2 + ln3 + ln4 + ln5
-    #labs = [l.get_label() for l in lines]
-    #ax[1].legend(lines, labs)
-
-    # make first two plots share yscale
-    y_min = min([ax[0].get_ylim()[0], ax[1].get_ylim()[0]])
-    y_max = max([ax[0].get_ylim()[1], ax[1].get_ylim()[1]])
-    ax[0].set_ylim((y_min, y_max))
-    ax[1].set_ylim((y_min, y_max))
-    ax[0].set_ylabel("Hamming distance")
-    ax[0].spines[['right', 'top']].set_visible(False)
-    a02.spines[['right', 'top']].set_visible(False)
-    a02.set_yticks([])
-    a12.set_ylabel("Number of substructures")
-    ax[1].spines[['left', 'top']].set_visible(False)
-    a12.spines[['left', 'top']].set_visible(False)
-    ax[1].set_yticks([])
-
-    plt.tight_layout()
-    plt.savefig(f.strip('design.txt')+'kinetic.png', dpi = 200)
-
-    fig, ax = plt.subplots()
-    ax.plot(boundspace, mfe_diff)
-    ax.set_ylabel("Hamming distance")
-    ax.set_xlabel("Subsequence length")
-    ax.set_title("Difference in MFE structure")
-    plt.tight_layout()
-    plt.savefig(f.strip('design.txt')+'fold_diff.png', dpi = 200)
+        add_constant_penalty(fc, penalty, last_structure, backend)
+
+        with instrument.phase('subopt_constrained', length=bound):
+            competing = fc.subopt(window)
+        instrument.record('subopt_size_constrained', len(competing), length=bound)
+
+        with instrument.phase('distances', length=bound):
+            con = ensemble_distances(competing, ref, ref_pt)
+        last_structure = pair_table(con['mfe'])
+
+        mfe_diff = int(hamming_distances(structure_matrix([comp['mfe']]), con['mfe'])[0])
+        steps.append({'length' : bound, 'comp' : comp, 'con' : con, 'mfe_diff' : mfe_diff})
+        if verbose:
+            print(f"Curr_length: {len(subseq)}, Comp_subs: {comp['n']}, Con_subs: {con['n']}, MFE_dist: {mfe_diff}, MFE_bp_dist (comp/con): {comp['mfe_bp']}/{con['mfe_bp']}")
+
+    return steps
+
+# One design file for utils.run_designs
+# Writes the <prefix>kinetic.json record that render.py draws the plots from
+def _run_design(f, out_dir, settings):
+    name, target, seq = read_design(f)
+    md = RNA.md()
+    md.temperature = settings['temperature']
+    if settings['trace']:
+        instrument.enable()
+        instrument.reset()
+    steps = fold_design(seq, target, md, settings['step'], settings['window'], settings['penalty'], settings['verbose'], settings.get('backend'))
+    if settings['trace']:
+        instrument.export(design_prefix(f, out_dir)+'instrument.json')
+        instrument.export(design_prefix(f, out_dir)+'kinetic.trace.json')
+
+    record = design_prefix(f, out_dir)+'kinetic.json'
+    with open(record, 'w') as out:
+        json.dump({'kind' : 'kinetic', 'name' : name, 'seq' : seq, 'target' : target, 'settings' : settings, 'steps' : steps}, out)
+
+    return {'length' : len(seq), 'steps' : len(steps), 'final_mfe_dist' : steps[-1]['mfe_diff']}, record
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog='kinetic-fold', description='Compare complete and constrained co-transcriptional folds of design files against their targets')
+    parser.add_argument('inputs', nargs='*', default=['.'], help="Design files, globs or directories (directories are searched for files with 'design' in the name, default: .)")
+    parser.add_argument('-o', '--output-dir', default='.', help='Where to write the per-design results and plots')
+    parser.add_argument('-s', '--step', type=int, default=10, help='Nucleotides added at each step')
+    parser.add_argument('-T', '--temperature', type=float, default=37, help='Folding temperature')
+    parser.add_argument('-w', '--window', type=int, default=100, help='Subopt window (dcal/mol)')
+    parser.add_argument('--penalty', type=int, default=500, help='Penalty for breaking a pair from the last step (dcal/mol)')
+    parser.add_argument('-b', '--backend', default=None, choices=['native', 'callback'], help='How the penalty is applied (default: penalties.BACKEND)')
+    parser.add_argument('-p', '--processes', type=int, default=None, help='Number of worker processes (default: all cores)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Print every step (best with -p 1)')
+    parser.add_argument('--trace', action='store_true', help='Write per-phase timings and callback counts (<name>_instrument.json) and a Chrome trace (<name>_kinetic.trace.json) for every design')
+    parser.add_argument('--no-render', action='store_true', help='Only write the result records, plot them later with render.py')
+    args = parser.parse_args(argv)
+
+    files = design_files(args.inputs)
+    if len(files) == 0:
+        parser.error('no design files found')
+    os.makedirs(args.output_dir, exist_ok=True)
+    settings = {'temperature' : args.temperature, 'step' : args.step, 'window' : args.window, 'penalty' : args.penalty, 'verbose' : args.verbose, 'trace' : args.trace, 'backend' : args.backend}
+    return run_designs(files, _run_design, args.output_dir, settings, ['length', 'steps', 'final_mfe_dist'], args.processes, not args.no_render)
+
+if __name__ == '__main__':
+    sys.exit(main())
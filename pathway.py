@@ -0,0 +1,144 @@
+import os
+import json
+import numpy as np
+from utils import stack_pair_tables, dot_bracket, compare_structures, PAD
+
+# A folding pathway as one array instead of a dict of dot-brackets
+#     pt        (n_lengths, width+1) int16, row i is the structure at lengths[i] in the stack_pair_tables format
+#               (pt[i, 0] is the length, positions past it are PAD)
+#     lengths   the prefix length of every row, ascending
+#     name, seq, func, pen   what the notebooks keep mixed in with the lengths (func is stored by name)
+# Structures are parsed once when the pathway is built, comparisons then work on the whole array at once.
+#
+#     p = FoldingPathway.from_dict(compute_data['mfe_const'], name='mfe_const')
+#     p[42]            dot-bracket at length 42, same as the dict
+#     p[30:60]         pathway for lengths 30 <= l < 60
+#     p.save('mfe_const.npz')
+#     p.compare(q)['MCC']    per-length MCC against another pathway
+#     compare_all([p, q, ...])['MCC'].mean(axis=-1)    the notebooks' all-vs-all mean MCC matrix
+
+class FoldingPathway:
+    def __init__(self, pt, lengths, name=None, seq=None, func=None, pen=None):
+        self.pt = pt
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.name = name
+        self.seq = seq
+        self.func = func if func is None or type(func) == str else func.__name__
+        self.pen = pen
+        self._index = {int(l) : i for i, l in enumerate(self.lengths)}
+
+    # From the notebooks' {length : db} or {length : {'mfe' : db, ...}} dicts,
+    # anything that isn't an int key ('func', 'pen') becomes metadata
+    @classmethod
+    def from_dict(cls, pathway, name=None, seq=None):
+        lengths = sorted(l for l in pathway.keys() if type(l) == int)
+        structures = [pathway[l]['mfe'] if type(pathway[l]) == dict else pathway[l] for l in lengths]
+        if seq is None and len(lengths) > 0 and type(pathway[lengths[-1]]) == dict:
+            seq = pathway[lengths[-1]].get('seq')
+        return cls(stack_pair_tables(structures) if structures else np.zeros((0, 1), dtype=np.int16), lengths,
+                   name, seq, pathway.get('func'), pathway.get('pen'))
+
+    # {length : db} like CotranscriptionalFolder.run() and the sweeps return
+    def to_dict(self):
+        return {int(l) : self.structure(l) for l in self.lengths}
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __contains__(self, length):
+        return length in self._index
+
+    def __iter__(self):
+        return iter(int(l) for l in self.lengths)
+
+    # Pair table at one length, without the padding
+    def pair_table(self, length):
+        row = self.pt[self._index[length]]
+        return row[:row[0]+1]
+
+    def structure(self, length):
+        return dot_bracket(self.pair_table(length))
+
+    # An int length gives its dot-bracket, a slice of lengths (start <= l < stop) gives a pathway sharing this one's array
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            if key.step is not None:
+                raise ValueError("Pathways are sliced by length, a step doesn't mean anything here")
+            lo = 0 if key.start is None else np.searchsorted(self.lengths, key.start, side='left')
+            hi = len(self.lengths) if key.stop is None else np.searchsorted(self.lengths, key.stop, side='left')
+            return FoldingPathway(self.pt[lo:hi], self.lengths[lo:hi], self.name, self.seq, self.func, self.pen)
+        return self.structure(key)
+
+    # Only the given lengths (all of them have to be in the pathway), padded out to width
+    def rows(self, lengths, width=None):
+        pt = self.pt[[self._index[int(l)] for l in lengths]]
+        width = pt.shape[1] - 1 if width is None else width
+        if width == pt.shape[1] - 1:
+            return pt
+        out = np.full((len(pt), width+1), PAD, dtype=np.int16)
+        n = min(width, pt.shape[1] - 1)
+        out[:, :n+1] = pt[:, :n+1]
+        return out
+
+    def meta(self):
+        return {'name' : self.name, 'seq' : self.seq, 'func' : self.func, 'pen' : self.pen}
+
+    # Files ending in .npz hold everything in one archive, anything else is a directory of
+    #     pt.npy  lengths.npy  meta.json
+    # which load() can memory-map, so a big set of pathways doesn't have to be read in to compare a few lengths
+    def save(self, filename):
+        if filename.endswith('.npz'):
+            np.savez(filename, pt=self.pt, lengths=self.lengths, meta=json.dumps(self.meta()))
+            return
+        os.makedirs(filename, exist_ok=True)
+        np.save(os.path.join(filename, 'pt.npy'), np.ascontiguousarray(self.pt))
+        np.save(os.path.join(filename, 'lengths.npy'), self.lengths)
+        with open(os.path.join(filename, 'meta.json'), 'w') as f:
+            json.dump(self.meta(), f)
+
+    @classmethod
+    def load(cls, filename, mmap=False):
+        if filename.endswith('.npz'):
+            with np.load(filename) as f:
+                return cls(f['pt'], f['lengths'], **json.loads(str(f['meta'])))
+        mode = 'r' if mmap else None
+        with open(os.path.join(filename, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        return cls(np.load(os.path.join(filename, 'pt.npy'), mmap_mode=mode), np.load(os.path.join(filename, 'lengths.npy')), **meta)
+
+    # compare_structures at every length both pathways have, each output is indexed like 'lengths'
+    def compare(self, other, lengths=None):
+        return compare_all([self], [other], lengths, squeeze=True)
+
+    def __repr__(self):
+        span = f"{self.lengths[0]}-{self.lengths[-1]}" if len(self) else 'empty'
+        return f"FoldingPathway({self.name!r}, {len(self)} lengths {span}, func={self.func!r}, pen={self.pen!r})"
+
+# Lengths every one of the pathways has
+def common_lengths(pathways):
+    lengths = None
+    for p in pathways:
+        lengths = p.lengths if lengths is None else np.intersect1d(lengths, p.lengths)
+    return [] if lengths is None else [int(l) for l in lengths]
+
+# Every pathway against every reference pathway at their common lengths, in one compare_structures call
+# Outputs have shape (len(pathways), len(references), len(lengths)), or (len(lengths),) with squeeze for a single pair
+# references defaults to pathways, which gives the all-vs-all comparison
+def compare_all(pathways, references=None, lengths=None, squeeze=False):
+    pathways = list(pathways)
+    references = pathways if references is None else list(references)
+    if lengths is None:
+        lengths = common_lengths(pathways + references)
+    width = max(l for l in lengths) if len(lengths) else 0
+
+    pred = np.stack([p.rows(lengths, width) for p in pathways])
+    ref = pred if references is pathways else np.stack([r.rows(lengths, width) for r in references])
+    out = compare_structures(pred, ref)
+    if squeeze:
+        out = {k : v[0, 0] for k, v in out.items()}
+    out['lengths'] = np.array(lengths)
+    return out
+
+# {name : FoldingPathway} for a dict of notebook pathways, e.g. shape_data or compute_data
+def pathways_from_dicts(data):
+    return {name : FoldingPathway.from_dict(d, name=name) for name, d in data.items()}
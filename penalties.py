@@ -1,20 +1,36 @@
 import RNA
 import numpy as np
-from utils import dict_dot_bracket
+import inspect
+import hashlib
+import os
+from functools import wraps
+from collections import Counter, OrderedDict
+from utils import pair_table, dot_bracket, md_settings, make_md
+from results import ResultStore
+import instrument
 
 # According to https://pubs.acs.org/doi/full/10.1021/jacs.0c03105
 # dG for each BM step is between 7.4 and 8.9 KbT (4.5-5.5 kcal/mol @ 37)
 
+# How the folding functions apply their penalties.
+# 'native' turns the penalty rules into a per-base-pair soft constraint matrix before folding
+# 'callback' registers the penalize_barriers* functions with sc_add_f, so Vienna calls back into python for every decomposition
+# Both produce the same structures, but native runs at close to plain fc.mfe() speed.
+BACKEND = 'native'
+
 ##################################
 ###     PENALTY FUNCTIONS      ###
 ##################################
 
+# The structure from the last step is passed around as a pair table (see utils.pair_table)
+# The callbacks get it as a plain list since indexing that from python is quicker than a numpy array
+
 #penalize opening a base pair by a constant amount
 def penalize_barriers(i, j, k, l, d, arg_dict):
     penalty = arg_dict['penalty'] # 20 is the best constant value for this.
     if d in [RNA.DECOMP_PAIR_IL, RNA.DECOMP_PAIR_HP, RNA.DECOMP_PAIR_ML]:
         ref = arg_dict['last']
-        if i in ref.keys():
+        if i <= ref[0] and ref[i] != 0:
             if ref[i] == j:
                 return 0
             else:
@@ -22,117 +38,570 @@ def penalize_barriers(i, j, k, l, d, arg_dict):
             
     return 0
 
-# eval_move is really expensive, so pre-assemble penalties for penalize_barriers_seq
-def get_penalties(last, fc):
-    last_dict = dict_dot_bracket(last)
-    out = {}
-    for i, c in enumerate(last):
-        if c == '(' or c == ')':
-            p = min((i+1, last_dict[i+1]))
-            q = max((i+1, last_dict[i+1]))
-            out[i+1] = int(fc.eval_move(last, -p, -q) * 100) # eval_move returns kcal/mol, penalties must be ints in dcal/mol
+# Least-recently-used cache that keeps count of how useful it's being
+class LRUCache:
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key in self.data:
+            self.hits += 1
+            self.data.move_to_end(key)
+            return self.data[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def clear(self):
+        self.data.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        return {'hits' : self.hits, 'misses' : self.misses, 'size' : len(self.data), 'maxsize' : self.maxsize}
+
+# The same (prefix, structure) comes up again and again: at consecutive lengths when the structure doesn't change,
+# and in a sweep for every penalty value that produced the same intermediate structure.
+# So the cost of breaking each pair is cached, keyed by (prefix sequence, structure, md settings).
+# BREAKING_CACHE.info() has the hit/miss counts.
+BREAKING_CACHE = LRUCache(4096)
+
+def md_key(md):
+    return tuple(sorted(md_settings(md).items()))
+
+# Cost (kcal/mol) of breaking each pair in structure, in an array indexed like its pair table (0 for unpaired)
+# fc is a plain (no soft constraints) fold compound for the sequence the structure belongs to.
+# eval_move only re-evaluates the loops either side of the pair, so this is one cheap call per pair.
+# (Re-evaluating the loops ourselves with eval_loop_pt is slower from python than letting eval_move do it.)
+def pair_breaking_energies(structure, fc):
+    db = structure if type(structure) == str else dot_bracket(structure)
+    key = (fc.sequence, db, md_key(fc.params.model_details))
+    out = BREAKING_CACHE.get(key)
+    if out is not None:
+        return out
+
+    pt = pair_table(db)
+    out = np.zeros(len(pt))
+    opening = np.nonzero(pt[1:] > np.arange(1, len(pt)))[0] + 1 # calculating eval_move on i > j returns bad stuff
+    for p in opening.tolist():
+        q = int(pt[p])
+        out[p] = out[q] = fc.eval_move(db, -p, -q)
+    out.flags.writeable = False
+    BREAKING_CACHE.put(key, out)
 
     return out
 
+# eval_move used to be called for every paired nucleotide at every step, so pre-assemble penalties for penalize_barriers_seq
+# Returns an array indexed like the pair table with the cost of breaking each nucleotide's pair (0 for unpaired)
+def get_penalties(last, fc):
+    return np.trunc(pair_breaking_energies(last, fc) * 100).astype(np.int32) # eval_move returns kcal/mol, penalties must be ints in dcal/mol
+
 
 #penalize opening a base pair by a percentage of the FE loss
 def penalize_barriers_seq(i, j, k, l, d, arg_dict):
     if d in [RNA.DECOMP_PAIR_IL, RNA.DECOMP_PAIR_HP, RNA.DECOMP_PAIR_ML]:
         penalty_percent = arg_dict['penalty_percent']
-        ref_dict = arg_dict['last_dict']
-        penalty_dict = arg_dict['penalty_dict']
+        ref = arg_dict['last']
+        penalties = arg_dict['penalties']
 
-        if i in ref_dict.keys():
-            if ref_dict[i] == j:
+        if i <= ref[0] and ref[i] != 0:
+            if ref[i] == j:
                 return 0
             else:
-                diff = penalty_dict[i]
+                diff = penalties[i]
                 penalty = int(diff * penalty_percent)
                 return penalty
             
     return 0 
 
+# Sparse store for the ensemble penalties
+# The penalty for pairing i,j is freqs[i][j] = p(i paired to not j) = p(i paired) - p(i paired to j)
+# Only the pairs seen in the last ensemble have a p(i paired to j), everything else in a row gets the row's default p(i paired).
+# So rather than a dense NxN matrix per step this keeps a per-row default and a dict of the observed pairs.
+# Nucleotides added since the last ensemble (past span) get no penalty, same as padding the dense matrix with zeros.
+# Indexing is 0-based, same as the dense freqs matrices: freqs[i-1, j-1]
+class SparsePenalties:
+    def __init__(self, length=0):
+        self.length = 0
+        self.span = 0
+        self.rows = np.zeros(max(length, 16))
+        self.pairs = {}
+        self.resize(length)
+
+    def __len__(self):
+        return self.length
+
+    # Penalty frequency for pairing i,j
+    def __getitem__(self, ij):
+        i, j = ij
+        if j >= self.span:
+            return 0.
+        return self.rows[i] - self.pairs.get((i, j), 0)
+
+    # Grow (or shrink) to a new transcript length
+    # rows is over-allocated so stepping along a transcript doesn't reallocate at every length
+    def resize(self, length):
+        if length > len(self.rows):
+            rows = np.zeros(max(length, 2*len(self.rows)))
+            rows[:self.length] = self.rows[:self.length]
+            self.rows = rows
+        elif length < self.length:
+            self.rows[length:self.length] = 0
+            self.pairs = {(i, j) : v for (i, j), v in self.pairs.items() if i < length and j < length}
+        self.length = length
+        self.span = min(self.span, length)
+
+    # Forget the last ensemble but keep the storage, ready to be filled with a new one of this length
+    def clear(self, length=0):
+        self.rows[:self.length] = 0
+        self.pairs.clear()
+        self.resize(length)
+        self.span = length
+
+    # Accumulate p(i paired to j)
+    def add(self, i, j, p):
+        self.pairs[(i, j)] = self.pairs.get((i, j), 0) + p
+        self.rows[i] += p
+
+    # A copy grown to length, so a result that's already been handed out (or stored) never changes under anyone
+    def resized(self, length):
+        out = SparsePenalties()
+        out.rows = self.rows.copy()
+        out.pairs = dict(self.pairs)
+        out.length = self.length
+        out.span = self.span
+        out.resize(length)
+        return out
+
+    # Everything that decides the penalties, for keying results on the last step
+    def key(self):
+        return self.rows[:self.length].tobytes() + repr((self.span, sorted(self.pairs.items()))).encode()
+
+    # Expand into an (n+1)x(n+1) matrix for the native backend, same as ensemble_penalty_matrix does for dense freqs
+    # This is only ever the transient matrix handed to sc_add_bp, the store itself stays sparse
+    def penalty_matrix(self, penalty):
+        M = np.zeros((self.length+1, self.length+1))
+        M[1:self.span+1, 1:self.span+1] = self.rows[:self.span, np.newaxis]
+        if self.pairs:
+            ij = np.array(list(self.pairs.keys())) + 1
+            M[ij[:, 0], ij[:, 1]] -= np.fromiter(self.pairs.values(), dtype=float, count=len(self.pairs))
+        M *= penalty
+        np.trunc(M, out=M) # int() truncates towards 0 for the negative penalties too
+
+        return M
+
 # Get the frequency with which a particular base pair is formed
 # Optionally also compute the cost of breaking that pair
-def pairing_frequency(ensemble, last_fc=None):
-    freqs = np.zeros((len(ensemble[0].structure), len(ensemble[0].structure)))
+# Returns a SparsePenalties covering the ensemble's structures, pass out to refill an existing one
+def pairing_frequency(ensemble, last_fc=None, out=None):
+    if out is None:
+        out = SparsePenalties()
+    out.clear(len(ensemble[0].structure))
+
     energies = np.array([e.energy for e in ensemble])
     energies *= -1 * 1.624 # convert to negative KbTs
     probs = np.exp(energies) / np.sum(np.exp(energies))
     for e, prob in zip(ensemble, probs):
         structure = e.structure
-        db = dict_dot_bracket(structure)
-        for k in db.keys():
-            if k > db[k]: # calculating eval_move on i > j returns bad stuff
-                continue
+        pt = pair_table(structure)
+        opening = np.nonzero(pt[1:] > np.arange(1, len(pt)))[0] + 1
+        if last_fc != None:
+            move_costs = pair_breaking_energies(structure, last_fc)
+        for k in opening.tolist():
             if last_fc == None:
                 # Probability that i and j are paired
-                freqs[k-1][db[k]-1] += prob # Vienna is 1-indexed, so dict_db is as well
+                out.add(k-1, int(pt[k])-1, prob) # Vienna is 1-indexed, so the pair table is as well
             else:
                 # Probability that i and j are paired, multiplied by the energy penalty for breaking them
-                move_cost = last_fc.eval_move(structure, -1*k, -1*db[k])
-                freqs[k-1][db[k]-1] += prob * move_cost * 100 # eval_move returns kcal/mol, need dcal/mol
-                freqs[db[k]-1][k-1] += prob * move_cost * 100 # do it symmetrically so there's a penalty on opening closing nucleotides
+                move_cost = move_costs[k]
+                out.add(k-1, int(pt[k])-1, prob * move_cost * 100) # eval_move returns kcal/mol, need dcal/mol
+                out.add(int(pt[k])-1, k-1, prob * move_cost * 100) # do it symmetrically so there's a penalty on opening closing nucleotides
 
-    # What we have is:  freqs[i][j] = p(i_paired_to_j)
-    # What we want is:  freqs[i][j] = p(i_paired_to_not_j)
-    freqs -= np.sum(freqs, axis=1)[:, np.newaxis] # negative penalties can happen!
-    freqs *= -1
-
-    return freqs
+    return out
 
 # Penalty based on the frequency with which i,j are not paired in the ensemble
 def penalize_barriers_ensemble(i, j, k, l, d, arg_dict):
     if d in [RNA.DECOMP_PAIR_IL, RNA.DECOMP_PAIR_HP, RNA.DECOMP_PAIR_ML]:
         freqs = arg_dict['freqs']
         penalty = arg_dict['penalty']
-        return int(freqs[i-1][j-1] * penalty)
+        return int(freqs[i-1, j-1] * penalty)
 
     return 0
 
+# The partition function needs Boltzmann factors rather than energies from the callbacks
+# The energy callback is bound at definition, so anything that wraps penalize_barriers_ensemble
+# to count Vienna's calls (benchmark.py) doesn't count these a second time
+def penalize_barriers_ensemble_exp(i, j, k, l, d, arg_dict, _penalty=penalize_barriers_ensemble):
+    return float(np.exp(-_penalty(i, j, k, l, d, arg_dict) * 10 / arg_dict['kT'])) # kT is in cal/mol
+
+##################################
+###     PENALTY MATRICES       ###
+##################################
+
+# The native backend expresses each penalty function as an (n+1)x(n+1) matrix (1-indexed like Vienna)
+# where M[i][j] is the penalty in dcal/mol for forming the pair i,j (i < j).
+# The callbacks only ever see pair decompositions with i < j, so only the upper triangle is used.
+
+# Rows of the penalty matrix that get penalized: nucleotides that were paired in the last structure
+def _paired_rows(length, last_pt):
+    rows = np.nonzero(last_pt[1:])[0] + 1
+    return rows[rows <= length]
+
+# Same rule as penalize_barriers
+def constant_penalty_matrix(length, last_pt, penalty):
+    M = np.zeros((length+1, length+1))
+    rows = _paired_rows(length, last_pt)
+    M[rows, :] = int(penalty)
+    M[rows, last_pt[rows]] = 0
+
+    return M
+
+# Same rule as penalize_barriers_seq
+def sequence_dependent_penalty_matrix(length, last_pt, penalties, penalty_percent):
+    M = np.zeros((length+1, length+1))
+    rows = _paired_rows(length, last_pt)
+    M[rows, :] = np.trunc(penalties[rows] * penalty_percent)[:, np.newaxis] # same as int()
+    M[rows, last_pt[rows]] = 0
+
+    return M
+
+# Same rule as penalize_barriers_ensemble
+def ensemble_penalty_matrix(freqs, penalty):
+    if isinstance(freqs, SparsePenalties):
+        return freqs.penalty_matrix(penalty)
+    M = np.zeros((len(freqs)+1, len(freqs)+1))
+    M[1:, 1:] = np.trunc(freqs * penalty) # int() truncates towards 0 for the negative penalties too
+
+    return M
+
+# Hand a penalty matrix to Vienna as soft constraints on base pairs
+def add_penalty_matrix(fc, M):
+    M = np.triu(M, 1)
+    if not M.any(): # nothing to penalize, don't bother
+        return
+    fc.sc_add_bp((M / 100).tolist()) # sc_add_bp takes kcal/mol, penalties are in dcal/mol
+
+def _backend(backend):
+    backend = BACKEND if backend is None else backend
+    if backend not in ['native', 'callback']:
+        raise ValueError(f"Unknown penalty backend '{backend}', expected 'native' or 'callback'")
+    return backend
+
+# Attach each kind of penalty to a fold compound using the selected backend
+# These take pre-parsed state so callers stepping along a transcript can reuse it
+def add_constant_penalty(fc, penalty, last_pt, backend=None):
+    if _backend(backend) == 'native':
+        add_penalty_matrix(fc, constant_penalty_matrix(fc.length, last_pt, penalty))
+    else:
+        step_info = {
+                'last' : last_pt.tolist(),
+                'penalty' : int(penalty)
+            }
+        fc.sc_add_f(instrument.callback(penalize_barriers))
+        fc.sc_add_data(step_info)
+
+def add_sequence_dependent_penalty(fc, penalty_percent, last_pt, penalties, backend=None):
+    if _backend(backend) == 'native':
+        add_penalty_matrix(fc, sequence_dependent_penalty_matrix(fc.length, last_pt, penalties, penalty_percent))
+    else:
+        step_info = {
+            'last' : last_pt.tolist(),
+            'penalties' : penalties.tolist(),
+            'penalty_percent' : penalty_percent
+            }
+        fc.sc_add_f(instrument.callback(penalize_barriers_seq))
+        fc.sc_add_data(step_info)
+
+# Pass kT (cal/mol) if the partition function is going to be computed, the callbacks need it for the Boltzmann factors
+def add_ensemble_penalty(fc, freqs, penalty, backend=None, kT=None):
+    if _backend(backend) == 'native':
+        add_penalty_matrix(fc, ensemble_penalty_matrix(freqs, penalty))
+    else:
+        step_info = {
+            'freqs' : freqs,
+            'penalty' : penalty,
+            'kT' : kT
+        }
+        fc.sc_add_f(instrument.callback(penalize_barriers_ensemble))
+        if kT is not None:
+            fc.sc_add_exp_f(instrument.callback(penalize_barriers_ensemble_exp))
+        fc.sc_add_data(step_info)
+
+# Dense p(i paired to j) (or cost weighted) from the bpp modes as a SparsePenalties, which is what they return.
+# Row totals are kept exactly, only pairs under cutoff are dropped, which moves their penalty by less than cutoff * penalty.
+def sparse_penalties(freqs, cutoff):
+    out = SparsePenalties(len(freqs))
+    out.clear(len(freqs))
+    out.rows[:len(freqs)] = freqs.sum(axis=1)
+    i, j = np.nonzero(np.abs(freqs) > cutoff)
+    out.pairs = dict(zip(zip(i.tolist(), j.tolist()), freqs[i, j].tolist()))
+    return out
+
+##################################
+###     WINDOWED REFOLDING     ###
+##################################
+
+# Refolding the whole prefix at every step is O(L^3) per step, which rules out anything RNase P sized.
+# Co-transcriptionally the new structure mostly forms at the 3' end, so the MFE modes can refold just a trailing window:
+#   - the window starts after an unpaired exterior loop nucleotide of the last structure, at least window nt from the 3' end,
+#     so none of the last structure's pairs cross into it
+#   - upstream of the window the last structure is kept as it is (the pairs it had are effectively hard constraints),
+#     the window is folded on its own with its share of the penalties, so no pair can span more than the window
+#   - if the window's structure pairs its first nucleotide, the boundary is in the way and the step is refolded in full
+#   - if closing a helix between the window and unpaired upstream nucleotides would lower the energy (see crossing_helix),
+#     the window would rather pair across the boundary and the step is refolded in full too
+# With the default dangles=2 the exterior loop energy splits cleanly at an unpaired nucleotide,
+# so the result is the MFE over all structures that keep the upstream part.
+# It's an approximation all the same: a full refold can also rearrange the upstream part (paying the penalties)
+# and pair it with the window, which neither check sees.  On ASE_00010 (316 nt, window 80) the windowed pathway matches
+# the full one at 84% of the lengths with constant_penalty 20 and 94% with sequence_dependent_penalty 0.05,
+# folder.window_agreement measures it for any transcript.
+# WINDOW_STATS counts how each step went: 'windowed', 'boundary' or 'crossing' (fell back) or 'no_window' (no usable start)
+WINDOW_STATS = Counter()
+
+# Start (0-indexed) of the window for a prefix of length, 0 if there's no usable start
+# The first nucleotide of the window and the one before it have to be unpaired in the exterior loop of the last structure.
+# The one before is folded along with the window (forced unpaired) so the dangles on a stem at the start of the window are right
+def window_start(last_pt, length, window):
+    n = int(last_pt[0])
+    limit = min(length - window, n)
+    if limit <= 1:
+        return 0
+    # depth[k] = number of pairs of the last structure that are open before position k (0-indexed)
+    idx = np.arange(1, n+1)
+    opens = (last_pt[1:] > idx).astype(np.int32)
+    closes = ((last_pt[1:] > 0) & (last_pt[1:] < idx)).astype(np.int32)
+    depth = np.concatenate([[0], np.cumsum(opens - closes)])
+    # k is a start if positions k-1 and k are unpaired and outside every pair,
+    # starting the window on an old stem would just get it paired again and hit the boundary check
+    unpaired = np.concatenate([last_pt[1:] == 0, [True]]) # new nucleotides are unpaired
+    usable = (depth[:limit] == 0) & unpaired[:limit] & unpaired[1:limit+1]
+    starts = np.nonzero(usable)[0] + 1
+    if len(starts) == 0:
+        return 0
+    return int(starts[-1])
+
+# The last structure's pair table for the window starting at offset
+def shift_pair_table(last_pt, offset):
+    n = int(last_pt[0])
+    pt = np.zeros(n - offset + 1, dtype=last_pt.dtype)
+    pt[0] = n - offset
+    pt[1:] = np.where(last_pt[offset+1:] > 0, last_pt[offset+1:] - offset, 0)
+    return pt
+
+# get_penalties output for the window starting at offset
+def window_penalties(penalties, offset):
+    if len(penalties) <= offset + 1:
+        return np.zeros(1, dtype=penalties.dtype)
+    return np.concatenate([[0], penalties[offset+1:]]).astype(penalties.dtype)
+
+PAIRS = {('A', 'U'), ('U', 'A'), ('G', 'C'), ('C', 'G'), ('G', 'U'), ('U', 'G')}
+
+# Whether the structure would go down in energy by closing a helix of at least min_stack pairs between unpaired
+# nucleotides of its exterior loop, one upstream of offset (1-indexed, inclusive) and one downstream of it.
+# Those are the pairs the window can't see, fc is an eval-only compound for the whole prefix.
+# Every stacked run from every pairable (i, j) is tried at every length, a cheap check next to the fold it can save.
+def crossing_helix(seq, structure, offset, fc, min_stack=2):
+    seq = seq.upper().replace('T', 'U')
+    pt = pair_table(structure)
+    n = len(seq)
+    idx = np.arange(1, n+1)
+    # depth after position k, an unpaired k is in the exterior loop if nothing is open over it
+    depth = np.cumsum((pt[1:] > idx).astype(np.int32) - ((pt[1:] > 0) & (pt[1:] < idx)).astype(np.int32))
+    free = np.concatenate([[False], (pt[1:] == 0) & (depth == 0)])
+    energy = None
+    upstream = [i for i in range(1, offset+1) if free[i]]
+    downstream = [j for j in range(offset+1, n+1) if free[j]]
+    for i in upstream:
+        for j in downstream:
+            if (seq[i-1], seq[j-1]) not in PAIRS:
+                continue
+            k = 1
+            while j - k - (i + k) > 3 and free[i+k] and free[j-k] and (seq[i+k-1], seq[j-k-1]) in PAIRS:
+                k += 1
+            if energy is None:
+                energy = fc.eval_structure(structure)
+            closed = list(structure)
+            for m in range(k):
+                closed[i+m-1], closed[j-m-1] = '(', ')'
+                if m + 1 >= min_stack and fc.eval_structure(''.join(closed)) < energy:
+                    return True
+    return False
+
+# Fold just the 3' window of seq, penalize(fc, offset) attaches the window's penalties
+# Returns [structure, energy] like fc.mfe(), or None if the step needs a full refold
+def window_fold(seq, last_structure, last_pt, window, penalize, md):
+    offset = window_start(last_pt, len(seq), window)
+    if offset == 0:
+        WINDOW_STATS['no_window'] += 1
+        return None
+
+    # One nucleotide of upstream context, kept unpaired, then the window
+    fc = RNA.fold_compound(seq[offset-1:], md)
+    fc.hc_add_up(1, RNA.CONSTRAINT_CONTEXT_ALL_LOOPS)
+    penalize(fc, offset-1)
+    with instrument.phase('mfe_window', length=len(seq)):
+        structure, energy = fc.mfe()
+    if structure[1] != '.':
+        WINDOW_STATS['boundary'] += 1
+        return None
+    WINDOW_STATS['windowed'] += 1
+
+    # Same energy a full fold would report: the whole structure plus whatever the penalties added in the window
+    fc.sc_remove()
+    window_structure = structure
+    structure = last_structure[:offset-1] + structure
+    # (an eval-only compound skips setting up the DP matrices for the whole prefix, evaluating doesn't need them)
+    full = RNA.fold_compound(seq, md, RNA.OPTION_EVAL_ONLY)
+    if crossing_helix(seq, structure, offset, full):
+        WINDOW_STATS['crossing'] += 1
+        return None
+    energy = full.eval_structure(structure) + energy - fc.eval_structure(window_structure)
+    return [structure, energy]
+
 ##################################
 ###     FOLDING FUNCTIONS      ###
 ##################################
 
+# Optional disk-backed store for fold results (see results.py), turned on with use_result_store()
+# With a store set the folding functions look every fold up there first and save whatever they had to compute,
+# so re-running a sweep or a notebook cell only folds the points that are missing.
+RESULT_STORE = None
+
+# store is a ResultStore or the path of one, None turns it off again
+def use_result_store(store, max_bytes=None):
+    global RESULT_STORE
+    if type(store) == str:
+        store = ResultStore(store, max_bytes)
+    RESULT_STORE = store
+    return store
+
+# Windowed folds can differ from full ones, so they're stored under their own name
+def stored_name(name, window=None, seed=None):
+    if window is not None:
+        name = f"{name}[window={window}]"
+    if seed is not None:
+        name = f"{name}[seed={seed}]"
+    return name
+
+# Read-through to RESULT_STORE, the backend doesn't change the result so it isn't part of the key
+# plain is for functions that ignore the penalty and last structure
+# Functions that take a seed are only stored when they get one, without it the result is different every time
+def stored(plain=False):
+    def decorate(func):
+        signature = inspect.signature(func)
+        md_default = signature.parameters['md'].default
+        windowed = 'window' in signature.parameters
+        seeded = 'seed' in signature.parameters
+        @wraps(func)
+        def wrapper(seq, param, last, md=md_default, *args, **kwargs):
+            with instrument.phase(func.__name__, length=len(seq)):
+                if RESULT_STORE is None:
+                    return func(seq, param, last, md, *args, **kwargs)
+                # window and seed can be passed by position as well, so they're read off the bound arguments
+                bound = signature.bind(seq, param, last, md, *args, **kwargs).arguments if windowed or seeded else {}
+                if seeded and bound.get('seed') is None:
+                    return func(seq, param, last, md, *args, **kwargs)
+                name = stored_name(func.__name__, bound.get('window'), bound.get('seed'))
+                key = RESULT_STORE.key(name, seq, 0, '', md) if plain else RESULT_STORE.key(name, seq, param, last, md)
+                with instrument.phase('store_get', length=len(seq)):
+                    result = RESULT_STORE.get(key)
+                if result is None:
+                    result = func(seq, param, last, md, *args, **kwargs)
+                    with instrument.phase('store_put', length=len(seq)):
+                        RESULT_STORE.put(key, result)
+                return result
+        return wrapper
+    return decorate
+
 # All the constraint functions have the same arguments so I can call them en-mass
+# The penalty functions also take a backend, which defaults to the module-level BACKEND
+@stored(plain=True)
 def no_constraint(seq, _, _2, md=RNA.md()):
     fc = RNA.fold_compound(seq, md)
-    return fc.mfe()
+    with instrument.phase('mfe', length=len(seq)):
+        return fc.mfe()
+
+# Vienna reads the reactivities at 1..len(seq), the rdat data at each length is one short of that,
+# so the end gets padded with -1 (no data). Otherwise Vienna reads past the end of the array and the fold changes from run to run.
+def shape_reactivities(reactivities, length):
+    reactivities = np.asarray(reactivities, dtype=np.float64)
+    if len(reactivities) > length:
+        return reactivities
+    return np.concatenate([reactivities, np.full(length + 1 - len(reactivities), -1.0)])
+
+# The notebooks fold the same SHAPE data over and over (every re-run, every calibration),
+# so the folds are cached by (sequence, reactivities, md settings). SHAPE_CACHE.info() has the hit/miss counts.
+SHAPE_CACHE = LRUCache(4096)
+
+def shape_key(seq, reactivities, md):
+    return (seq, hashlib.sha1(np.ascontiguousarray(reactivities, dtype=np.float64).tobytes()).hexdigest(), md_key(md))
+
+# SHAPE constrained MFE on a fold compound for seq that can be reused, whatever soft constraints it had are replaced
+def shape_fold(fc, seq, reactivities, md):
+    reactivities = shape_reactivities(reactivities, len(seq))
+    key = shape_key(seq, reactivities, md)
+    result = SHAPE_CACHE.get(key)
+    if result is None:
+        fc.sc_remove()
+        #fc.sc_add_SHAPE_deigan(reactivities, 2.6, -0.8)
+        fc.sc_add_SHAPE_zarringhalam(reactivities.tolist(), 0.8, 0.5, 'M')
+        result = fc.mfe()
+        SHAPE_CACHE.put(key, result)
+    return list(result)
 
 def shape_constraint(seq, reactivities, md=RNA.md()):
-    fc = RNA.fold_compound(seq, md)
-    #fc.sc_add_SHAPE_deigan(reactivities, 2.6, -0.8)
-    fc.sc_add_SHAPE_zarringhalam(reactivities, 0.8, 0.5, 'M')
-    return fc.mfe()
+    return shape_fold(RNA.fold_compound(seq, md), seq, reactivities, md)
+
+# The MFE penalty modes take a window to only refold the 3' end, an approximation of the full refold (see window_fold)
+@stored()
+def constant_penalty(seq, penalty, last_structure, md=RNA.md(), backend=None, window=None):
+    if window is not None and last_structure != '':
+        last_pt = pair_table(last_structure)
+        result = window_fold(seq, last_structure, last_pt, window,
+                             lambda fc, offset: add_constant_penalty(fc, penalty, shift_pair_table(last_pt, offset), backend), md)
+        if result is not None:
+            return result
 
-def constant_penalty(seq, penalty, last_structure, md=RNA.md()):
     fc = RNA.fold_compound(seq, md)
-    step_info = {
-            'last' : dict_dot_bracket(last_structure),
-            'penalty' : int(penalty)
-        }
-    fc.sc_add_f(penalize_barriers)
-    fc.sc_add_data(step_info)
+    with instrument.phase('add_penalties', length=len(seq)):
+        add_constant_penalty(fc, penalty, pair_table(last_structure), backend)
 
-    return fc.mfe()
+    with instrument.phase('mfe', length=len(seq)):
+        return fc.mfe()
 
-def sequence_dependent_penalty(seq, penalty_percent, last_structure, md=RNA.md()):
-    fc = RNA.fold_compound(seq, md)
+@stored()
+def sequence_dependent_penalty(seq, penalty_percent, last_structure, md=RNA.md(), backend=None, window=None):
     if last_structure != '':
-        fc_last = RNA.fold_compound(seq[:len(last_structure)], md)
-        penalty_dict = get_penalties(last_structure, fc_last)
-        #p_list.extend([v for v in penalty_dict.values()]) #was used to get average penalty
+        with instrument.phase('get_penalties', length=len(seq)):
+            fc_last = RNA.fold_compound(seq[:len(last_structure)], md)
+            penalties = get_penalties(last_structure, fc_last)
+        #p_list.extend(penalties[penalties != 0]) #was used to get average penalty
     else:
-        penalty_dict = {}
-    step_info = {
-        'last_dict' : dict_dot_bracket(last_structure),
-        'penalty_dict' : penalty_dict,
-        'penalty_percent' : penalty_percent
-        }
-    fc.sc_add_f(penalize_barriers_seq)
-    fc.sc_add_data(step_info)
+        penalties = np.zeros(1, dtype=np.int32)
 
-    return fc.mfe()
+    if window is not None and last_structure != '':
+        last_pt = pair_table(last_structure)
+        result = window_fold(seq, last_structure, last_pt, window,
+                             lambda fc, offset: add_sequence_dependent_penalty(fc, penalty_percent, shift_pair_table(last_pt, offset),
+                                                                               window_penalties(penalties, offset), backend), md)
+        if result is not None:
+            return result
+
+    fc = RNA.fold_compound(seq, md)
+    with instrument.phase('add_penalties', length=len(seq)):
+        add_sequence_dependent_penalty(fc, penalty_percent, pair_table(last_structure), penalties, backend)
+
+    with instrument.phase('mfe', length=len(seq)):
+        return fc.mfe()
 
 # This didn't work very well and made the function swapping complicated with its extra argument
 #def hierarchical_fold(seq, penalty, last_structure, span):
@@ -149,41 +618,128 @@ def sequence_dependent_penalty(seq, penalty_percent, last_structure, md=RNA.md()
 #
 #    return fc.mfe()
 
-def constant_ensemble_penalty(seq, penalty, last_ensemble, md=RNA.md()):
-    if last_ensemble != []:
-        last_freqs = pairing_frequency(last_ensemble)
-    else:
-        last_freqs = np.zeros(len(seq))
-
-    freqs = np.zeros((len(seq), len(seq)))
-    freqs[:len(last_freqs), :len(last_freqs)] = last_freqs
-        
-    step_info = {
-        'freqs' : freqs,
-        'penalty' : int(penalty)
-    }
+# subopt(500) for the ensemble modes, timed and with the ensemble size recorded
+def _subopt(fc, length):
+    with instrument.phase('subopt', length=length):
+        ensemble = fc.subopt(500)
+    instrument.record('subopt_size', len(ensemble), length=length)
+    return ensemble
+
+@stored()
+def constant_ensemble_penalty(seq, penalty, last_ensemble, md=RNA.md(), backend=None):
+    with instrument.phase('pairing_frequency', length=len(seq)):
+        if last_ensemble != []:
+            freqs = pairing_frequency(last_ensemble)
+        else:
+            freqs = SparsePenalties()
+        freqs.resize(len(seq))
+
+    fc = RNA.fold_compound(seq, md)
+    with instrument.phase('add_penalties', length=len(seq)):
+        add_ensemble_penalty(fc, freqs, int(penalty), backend)
+
+    return _subopt(fc, len(seq))
+
+@stored()
+def sequence_dependent_ensemble_penalty(seq, percent, last_ensemble, md=RNA.md(), backend=None):
+    with instrument.phase('pairing_frequency', length=len(seq)):
+        if last_ensemble != []:
+            fc_last = RNA.fold_compound(seq[:len(last_ensemble[0].structure)], md)
+            freqs = pairing_frequency(last_ensemble, fc_last)
+        else:
+            freqs = SparsePenalties()
+        freqs.resize(len(seq))
+
     fc = RNA.fold_compound(seq, md)
-    fc.sc_add_f(penalize_barriers_ensemble)
-    fc.sc_add_data(step_info)
+    with instrument.phase('add_penalties', length=len(seq)):
+        add_ensemble_penalty(fc, freqs, percent, backend)
 
-    return fc.subopt(500)
+    return _subopt(fc, len(seq))
 
-def sequence_dependent_ensemble_penalty(seq, percent, last_ensemble, md=RNA.md()):
-    if last_ensemble != []:
-        fc_last = RNA.fold_compound(seq[:len(last_ensemble[0].structure)], md)
-        last_freqs = pairing_frequency(last_ensemble, fc_last)
+# The subopt(500) ensembles above get expensive as the prefix grows, the number of structures within 5 kcal/mol explodes.
+# These get the pairing frequencies from the partition function instead, so the cost per step is polynomial.
+# Rather than an ensemble they return (mfe structure, mfe energy, freqs), where freqs is p(i paired to not j)
+# for this prefix (same as pairing_frequency) and is what the next step uses as its penalties.
+# Pass '' or [] as last_ensemble for the first step.
+
+# Number of Boltzmann samples used to estimate the cost of breaking each pair in sequence_dependent_bpp_penalty
+BPP_SAMPLES = 100
+# Pair probabilities (or probability weighted costs) under this aren't kept in the result
+BPP_CUTOFF = 1e-5
+
+# kT in cal/mol, for turning penalties into Boltzmann factors
+def _kT(md):
+    return (md.temperature + 273.15) * 1.98717 * md.betaScale
+
+# Fold with the penalties from the last step and compute the (penalized) partition function
+# The last step's penalties are one nucleotide (or step) shorter, new nucleotides get no penalty
+def _bpp_fold(seq, penalty, last_ensemble, md, backend):
+    if len(last_ensemble) != 0:
+        freqs = last_ensemble[2].resized(len(seq))
     else:
-        last_freqs = np.zeros(len(seq))
-
-    freqs = np.zeros((len(seq), len(seq)))
-    freqs[:len(last_freqs), :len(last_freqs)] = last_freqs
-        
-    step_info = {
-        'freqs' : freqs,
-        'penalty' : percent
-    }
+        freqs = SparsePenalties(len(seq))
+
     fc = RNA.fold_compound(seq, md)
-    fc.sc_add_f(penalize_barriers_ensemble)
-    fc.sc_add_data(step_info)
+    with instrument.phase('add_penalties', length=len(seq)):
+        add_ensemble_penalty(fc, freqs, penalty, backend, _kT(md))
+    with instrument.phase('mfe', length=len(seq)):
+        structure, energy = fc.mfe()
+    with instrument.phase('pf', length=len(seq)):
+        fc.exp_params_rescale(energy)
+        fc.pf()
+
+    return fc, structure, energy
+
+@stored()
+def constant_bpp_penalty(seq, penalty, last_ensemble, md=RNA.md(), backend=None):
+    fc, structure, energy = _bpp_fold(seq, int(penalty), last_ensemble, md, backend)
+
+    # Probability that i and j are paired, same as pairing_frequency only counts each pair once
+    with instrument.phase('bpp', length=len(seq)):
+        bpp = np.array(fc.bpp())
+        freqs = np.triu(bpp[1:, 1:], 1)
+
+    return structure, energy, sparse_penalties(freqs, BPP_CUTOFF)
+
+# Vienna's sampler is process-global, so seeding it here would hijack whatever samples next.
+# With a seed (the sweep and shard runners pass one) every step reseeds it from the seed and the step itself,
+# so the same step always draws the same sample and can be stored, then puts it back on fresh entropy.
+# Without one it samples from wherever the generator is and the result isn't stored.
+def _step_seed(seed, seq, percent):
+    return int(hashlib.sha1(repr((seed, seq, float(percent))).encode()).hexdigest()[:8], 16)
+
+@stored()
+def sequence_dependent_bpp_penalty(seq, percent, last_ensemble, md=RNA.md(), backend=None, seed=None):
+    # pbacktrack needs unique multiloop decomposition
+    md = make_md(md_settings(md))
+    md.uniq_ML = 1
+    fc, structure, energy = _bpp_fold(seq, percent, last_ensemble, md, backend)
+
+    with instrument.phase('bpp', length=len(seq)):
+        bpp = np.array(fc.bpp())
+    # Estimate the cost of breaking each pair from a Boltzmann sample of the (penalized) ensemble
+    # The mfe is always included so the dominant pairs always get a cost
+    with instrument.phase('pbacktrack', length=len(seq)):
+        if seed is not None:
+            RNA.init_rand(_step_seed(seed, seq, percent))
+        samples = list(fc.pbacktrack(BPP_SAMPLES)) + [structure]
+        if seed is not None:
+            RNA.init_rand(int.from_bytes(os.urandom(4), 'little'))
+    fc.sc_remove() # breaking costs don't include the penalties, same as pairing_frequency
+    cost = np.zeros((len(seq)+1, len(seq)+1))
+    count = np.zeros((len(seq)+1, len(seq)+1))
+    with instrument.phase('get_penalties', length=len(seq)):
+        for sample, n in Counter(samples).items():
+            pt = pair_table(sample)
+            penalties = get_penalties(sample, fc)
+            opening = np.nonzero(pt[1:] > np.arange(1, len(pt)))[0] + 1
+            cost[opening, pt[opening]] += n * penalties[opening]
+            count[opening, pt[opening]] += n
+
+    # p(i paired to j) * mean cost of breaking it, pairs that never got sampled are too rare to matter
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cost = np.where(count > 0, cost / count, 0)
+    freqs = (bpp * cost)[1:, 1:]
+    freqs += freqs.T # do it symmetrically so there's a penalty on opening closing nucleotides
 
-    return fc.subopt(500)
\ No newline at end of file
+    return structure, energy, sparse_penalties(freqs, BPP_CUTOFF)
@@ -0,0 +1,143 @@
+import numpy as np
+import os
+import json
+from utils import parse_rdat
+
+# Columnar cache for a directory of RDAT files (like SRP_test/ or flouride_test/)
+# Parsing the text files into lists of python floats and re-stacking the replicates happens every time a notebook starts.
+# Instead the directory is converted once into
+#     <dir>/.rdat_cache/reactivities.npy   every reactivity as float32, back to back
+#     <dir>/.rdat_cache/meta.json          source files (size and mtime), replicate names, probes and per-length blocks
+# For each construct length the replicates measured at that length are stored as one contiguous
+# (n_replicates, n_reactivities) block, so aggregating replicates is a single reduction over a memory-mapped view.
+# The cache is rebuilt whenever a source file is added, removed or changed.
+
+CACHE_DIR = '.rdat_cache'
+CACHE_VERSION = 1
+
+# SRPECLI_BZCN_0001.rdat.txt -> BZCN_0001, same names the notebooks use
+def replicate_name(filename):
+    name = os.path.basename(filename)
+    for ext in ['.txt', '.rdat']:
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    return name.split('_', 1)[-1]
+
+# The chemical probe, from the file-level 'ANNOTATION modifier:...' line
+def rdat_modifier(filename):
+    with open(filename, 'r') as f:
+        for l in f:
+            if l.startswith('ANNOTATION') and not l.startswith('ANNOTATION_DATA'):
+                for field in l.split():
+                    if field.startswith('modifier:'):
+                        return field[len('modifier:'):]
+    return 'none'
+
+def _rdat_files(path):
+    return sorted(os.path.join(path, f) for f in os.listdir(path)
+                  if 'rdat' in f and not f.startswith('.') and os.path.isfile(os.path.join(path, f)))
+
+def _source_stamp(files):
+    return [[os.path.basename(f), os.stat(f).st_size, os.stat(f).st_mtime] for f in files]
+
+class RdatStore:
+    def __init__(self, path, meta, react):
+        self.path = path
+        self.meta = meta
+        self.data = react
+        self.replicates = meta['replicates']
+        self.probes = meta['probes']
+        self.lengths = [b['length'] for b in meta['blocks']]
+        self._blocks = {b['length'] : b for b in meta['blocks']}
+
+    # Sequence of the construct at this length
+    def seq(self, length):
+        return self._blocks[length]['seq']
+
+    # Replicates measured at this length (optionally only one probe) and their (n_replicates, n_reactivities) block
+    def block(self, length, probe=None):
+        b = self._blocks[length]
+        members = b['members']
+        rows = self.data[b['offset']:b['offset'] + len(members) * b['width']].reshape(len(members), b['width'])
+        if probe is None:
+            return [self.replicates[m] for m in members], rows
+        keep = [i for i, m in enumerate(members) if self.probes[m].upper() == probe.upper()]
+        return [self.replicates[members[i]] for i in keep], rows[keep]
+
+    # Reactivities for one replicate at one length
+    def react(self, replicate, length):
+        names, rows = self.block(length)
+        return rows[names.index(replicate)]
+
+    # Combine the replicates at every length, e.g. aggregate('BzCN') for the notebooks' mean_BZCN
+    # Returns the same {length : {'seq', 'react'}} shape as parse_rdat
+    # The reactivities come out as float64, Vienna's SHAPE functions won't take float32
+    def aggregate(self, probe=None, func=np.mean):
+        return {l : {'seq' : self.seq(l), 'react' : func(self.block(l, probe)[1].astype(np.float64), axis=0)} for l in self.lengths}
+
+    # One replicate in the parse_rdat shape
+    def dataset(self, replicate):
+        return {l : {'seq' : self.seq(l), 'react' : self.react(replicate, l).astype(np.float64)}
+                for l in self.lengths if replicate in self.block(l)[0]}
+
+    # Everything the SRP notebook builds by hand: each replicate plus a mean_<PROBE> per probe
+    def shape_data(self, means=True):
+        out = {r : self.dataset(r) for r in self.replicates}
+        if means:
+            for probe in sorted(set(self.probes), key=self.probes.index):
+                out['mean_' + probe.upper()] = self.aggregate(probe)
+        return out
+
+# Convert every rdat file in path into the columnar layout
+def build_rdat_cache(path):
+    files = _rdat_files(path)
+    parsed = [parse_rdat(f) for f in files]
+    lengths = sorted(set(l for p in parsed for l in p.keys()))
+
+    blocks = []
+    chunks = []
+    offset = 0
+    for l in lengths:
+        members = [i for i, p in enumerate(parsed) if l in p]
+        width = len(parsed[members[0]][l]['react'])
+        block = np.array([parsed[m][l]['react'] for m in members], dtype=np.float32)
+        blocks.append({'length' : l, 'seq' : parsed[members[0]][l]['seq'], 'offset' : offset, 'width' : width, 'members' : members})
+        chunks.append(block.ravel())
+        offset += block.size
+
+    meta = {
+        'version' : CACHE_VERSION,
+        'sources' : _source_stamp(files),
+        'replicates' : [replicate_name(f) for f in files],
+        'probes' : [rdat_modifier(f) for f in files],
+        'blocks' : blocks
+    }
+
+    cache = os.path.join(path, CACHE_DIR)
+    os.makedirs(cache, exist_ok=True)
+    if os.path.exists(os.path.join(cache, 'meta.json')):
+        os.remove(os.path.join(cache, 'meta.json'))
+    np.save(os.path.join(cache, 'reactivities.npy'), np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.float32))
+    # meta goes last, so a half-written cache never looks valid
+    with open(os.path.join(cache, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    return meta
+
+# Load a directory of rdat files through the cache, building or rebuilding it if needed
+def load_rdat_dir(path, mmap=True):
+    cache = os.path.join(path, CACHE_DIR)
+    meta = None
+    try:
+        with open(os.path.join(cache, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        if meta.get('version') != CACHE_VERSION or meta['sources'] != _source_stamp(_rdat_files(path)):
+            meta = None
+    except (OSError, ValueError, KeyError):
+        meta = None
+
+    if meta is None:
+        meta = build_rdat_cache(path)
+
+    react = np.load(os.path.join(cache, 'reactivities.npy'), mmap_mode='r' if mmap else None)
+    return RdatStore(path, meta, react)
@@ -0,0 +1,180 @@
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from multiprocessing import Pool
+from utils import design_files, print_summary
+
+# Plots for the records kinetic.py and check_subopt.py write, kept out of the compute scripts so their workers never load matplotlib
+#     <prefix>kinetic.json   -> <prefix>kinetic.png and <prefix>fold_diff.png
+#     <prefix>ensemble.json  -> <prefix>ensemble.png
+# Figures can be redrawn from the records at any time without refolding anything.
+
+RECORD_SUFFIXES = {'kinetic' : 'kinetic.json', 'ensemble' : 'ensemble.json'}
+
+# The per-length stats from a kinetic record as arrays
+# The original script kept these in integer arrays, so the medians get truncated the same way
+def kinetic_columns(record):
+    steps = record['steps']
+    columns = {'boundspace' : np.array([s['length'] for s in steps]), 'mfe_diff' : np.array([s['mfe_diff'] for s in steps])}
+    for fold in ['comp', 'con']:
+        for stat, name in [('min', 'mins'), ('max', 'maxes'), ('median', 'meds'), ('mfe_dist', 'mfes'), ('n', 'n_sub')]:
+            columns[f'{name}_{fold}'] = np.array([s[fold][stat] for s in steps]).astype(int)
+    return columns
+
+def plot_kinetic(record, prefix):
+    r = kinetic_columns(record)
+    boundspace = r['boundspace']
+
+    # let's plot the min, med and max and see that path to the final structure.
+    fig, ax = plt.subplots(1, 2, figsize=(10, 5))
+    a02 = ax[0].twinx()
+    ln1 = a02.plot(boundspace, r['n_sub_comp'], 'r--', label='n structures')
+    ln2 = ax[0].plot(boundspace, r['maxes_comp'], label='max dist', c='deepskyblue')
+    ln3 = ax[0].plot(boundspace, r['meds_comp'], label='median dist', c='royalblue')
+    ln4 = ax[0].plot(boundspace, r['mfes_comp'], label='mfe dist', c='g')
+    ln5 = ax[0].plot(boundspace, r['mins_comp'], label='min dist', c='darkblue')
+    ax[0].set_title("Complete fold")
+    ax[0].set_xlabel("subsequence length")
+
+    lines = ln1 + ln2 + ln3 + ln4 + ln5
+    labs = [l.get_label() for l in lines]
+    ax[0].legend(lines, labs)
+
+    a12 = ax[1].twinx()
+    ln1 = a12.plot(boundspace, r['n_sub_con'], 'r--', label='n structures')
+    ln2 = ax[1].plot(boundspace, r['maxes_con'], label='max dist', c='deepskyblue')
+    ln3 = ax[1].plot(boundspace, r['meds_con'], label='median dist', c='royalblue')
+    ln4 = ax[1].plot(boundspace, r['mfes_con'], label='mfe dist', c='g')
+    ln5 = ax[1].plot(boundspace, r['mins_con'], label='min dist', c='darkblue')
+    ax[1].set_xlabel("Subsequence length")
+    ax[1].set_title("Constrained fold")
+
+    #lines = ln1 + ln2 + ln3 + ln4 + ln5
+    #labs = [l.get_label() for l in lines]
+    #ax[1].legend(lines, labs)
+
+    # make first two plots share yscale
+    y_min = min([ax[0].get_ylim()[0], ax[1].get_ylim()[0]])
+    y_max = max([ax[0].get_ylim()[1], ax[1].get_ylim()[1]])
+    ax[0].set_ylim((y_min, y_max))
+    ax[1].set_ylim((y_min, y_max))
+    ax[0].set_ylabel("Hamming distance")
+    ax[0].spines[['right', 'top']].set_visible(False)
+    a02.spines[['right', 'top']].set_visible(False)
+    a02.set_yticks([])
+    a12.set_ylabel("Number of substructures")
+    ax[1].spines[['left', 'top']].set_visible(False)
+    a12.spines[['left', 'top']].set_visible(False)
+    ax[1].set_yticks([])
+
+    plt.tight_layout()
+    plt.savefig(prefix+'kinetic.png', dpi = 200)
+    plt.close(fig)
+
+    fig, ax = plt.subplots()
+    ax.plot(boundspace, r['mfe_diff'])
+    ax.set_ylabel("Hamming distance")
+    ax.set_xlabel("Subsequence length")
+    ax.set_title("Difference in MFE structure")
+    plt.tight_layout()
+    plt.savefig(prefix+'fold_diff.png', dpi = 200)
+    plt.close(fig)
+
+    return [prefix+'kinetic.png', prefix+'fold_diff.png']
+
+# minimum energy for each distance ended up really noisy because the good structures are evenly spaced 2 apart.
+# get the minimum of each pair and use that.
+def min_energy_line(min_e):
+    distance_values = sorted(min_e.keys())
+    min_energies = [min_e[d] for d in distance_values]
+
+    lineX = []
+    lineY = []
+    for d, m in zip(zip(*[iter(distance_values)]*2), zip(*[iter(min_energies)]*2)): #that's pythonic, apparently.
+        min_idx = min(range(len(m)), key=m.__getitem__)
+        lineX.append(d[min_idx])
+        lineY.append(m[min_idx])
+
+    return lineX, lineY
+
+# Plot all the distance/energy pairs and put a bounding line on the min energies.
+# Structures that land on the same point used to be drawn on top of each other at alpha 0.1,
+# each point is now drawn once with the opacity that stack would have had.
+def plot_landscape(record, prefix):
+    points = np.array(record['points'], dtype=float).reshape(-1, 3)
+    distances = points[:, 0].astype(int)
+    energies = points[:, 1]
+    colors = np.zeros((len(points), 4))
+    colors[:, :3] = matplotlib.colors.to_rgb('C0')
+    colors[:, 3] = 1 - 0.9**points[:, 2]
+
+    lineX, lineY = min_energy_line({d : e for d, e in record['min_e']})
+
+    fig, ax = plt.subplots()
+    ax.scatter(distances, energies, c=colors)
+    ax.plot(lineX, lineY, 'b--')
+    ax.set_ylabel('Free energy (kcal/mol)')
+    ax.set_xlabel('Hamming distance')
+    ax.set_xticks(np.arange(min(distances), max(distances)+1, 1))
+    plt.tight_layout()
+    plt.savefig(prefix+'ensemble.png', dpi = 200)
+    plt.close(fig)
+
+    return [prefix+'ensemble.png']
+
+PLOTS = {'kinetic' : plot_kinetic, 'ensemble' : plot_landscape}
+
+# Draw the figures for one record, next to it or in out_dir
+def render_record(filename, out_dir=None):
+    with open(filename, 'r') as f:
+        record = json.load(f)
+    kind = record['kind']
+    prefix = filename[:-len(RECORD_SUFFIXES[kind])]
+    if out_dir is not None:
+        prefix = os.path.join(out_dir, os.path.basename(prefix))
+    return PLOTS[kind](record, prefix)
+
+def _render(task):
+    filename, out_dir = task
+    start = time.time()
+    try:
+        figures = render_record(filename, out_dir)
+        return filename, {'figures' : len(figures), 'seconds' : f"{time.time() - start:.2f}", 'status' : 'ok'}
+    except Exception as e:
+        return filename, {'figures' : 0, 'seconds' : f"{time.time() - start:.2f}", 'status' : f"failed: {e}"}
+
+# Render a list of records, processes=1 draws them all in this process
+def render_files(filenames, out_dir=None, processes=1):
+    tasks = [(f, out_dir) for f in filenames]
+    if processes == 1 or len(tasks) <= 1:
+        return list(map(_render, tasks))
+    with Pool(processes) as pool:
+        return list(pool.imap(_render, tasks))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='render', description='Draw the plots for kinetic-fold and subopt-landscape result records')
+    parser.add_argument('inputs', nargs='*', default=['.'], help='Result records, globs or directories (default: .)')
+    parser.add_argument('-o', '--output-dir', default=None, help='Where to write the figures (default: next to each record)')
+    parser.add_argument('-p', '--processes', type=int, default=1, help='Number of worker processes')
+    args = parser.parse_args(argv)
+
+    files = design_files(args.inputs, match=lambda f: f.endswith(tuple(RECORD_SUFFIXES.values())))
+    if len(files) == 0:
+        parser.error('no result records found')
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    start = time.time()
+    rows = render_files(files, args.output_dir, args.processes)
+    print_summary(rows)
+    print(f"{len(files)} records in {time.time() - start:.1f}s")
+    return 0 if all(r['status'] == 'ok' for _, r in rows) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,118 @@
+import os
+import time
+import pickle
+import sqlite3
+import hashlib
+from collections import namedtuple
+from utils import md_settings
+
+# Disk-backed store for folding results, so an interrupted sweep (or a restarted kernel) picks up where it left off.
+# Each fold is keyed by
+#     (sequence hash, penalty function, penalty value, md settings, length)
+# where the sequence hash covers the prefix being folded and the state carried over from the last step,
+# since the same prefix can be reached with different previous structures.
+# It's an sqlite database in WAL mode, so any number of worker processes can read and write it at once.
+# With max_bytes set, the least recently used results are evicted once the store grows past it.
+
+# subopt returns SWIG objects that can't be pickled, they're stored as these instead (same .structure and .energy)
+SubOpt = namedtuple('SubOpt', ['structure', 'energy'])
+
+def _digest(*parts):
+    h = hashlib.sha1()
+    for p in parts:
+        h.update(repr(p).encode())
+        h.update(b'\0')
+    return h.hexdigest()
+
+# Something hashable that describes whatever the last step left behind
+def _state(last):
+    if type(last) == str:
+        return last
+    if len(last) == 0:
+        return ''
+    if isinstance(last, tuple) and len(last) == 3: # the bpp modes' (structure, energy, SparsePenalties)
+        return (last[0], last[1], hashlib.sha1(last[2].key()).hexdigest())
+    return tuple((e.structure, e.energy) for e in last)
+
+# Make a folding result picklable
+def portable(result):
+    if isinstance(result, (list, tuple)) and len(result) > 0 and hasattr(result[0], 'structure'):
+        return [SubOpt(e.structure, e.energy) for e in result]
+    return result
+
+class ResultStore:
+    def __init__(self, path, max_bytes=None, timeout=60):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._conn = None
+        self._pid = None
+        self._connect().execute('''CREATE TABLE IF NOT EXISTS results (
+                                   seq_hash TEXT, func TEXT, penalty TEXT, md_hash TEXT, length INTEGER,
+                                   value BLOB, size INTEGER, accessed REAL,
+                                   PRIMARY KEY (seq_hash, func, penalty, md_hash, length))''')
+        self._connect().execute('CREATE INDEX IF NOT EXISTS accessed_idx ON results (accessed)')
+
+    # Connections can't be shared across a fork, so every process opens its own
+    def _connect(self):
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._pid = os.getpid()
+        return self._conn
+
+    # Workers get the path rather than the connection
+    def __getstate__(self):
+        return {'path' : self.path, 'max_bytes' : self.max_bytes, 'timeout' : self.timeout}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['max_bytes'], state['timeout'])
+
+    def key(self, func, seq, penalty, last, md):
+        func = func if type(func) == str else func.__name__
+        return (_digest(seq, _state(last)), func, repr(float(penalty)), _digest(sorted(md_settings(md).items())), len(seq))
+
+    def get(self, key):
+        row = self._connect().execute('SELECT value FROM results WHERE seq_hash=? AND func=? AND penalty=? AND md_hash=? AND length=?', key).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._connect().execute('UPDATE results SET accessed=? WHERE seq_hash=? AND func=? AND penalty=? AND md_hash=? AND length=?', (time.time(),) + key)
+        return pickle.loads(row[0])
+
+    def put(self, key, value):
+        blob = pickle.dumps(portable(value))
+        self._connect().execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)', key + (blob, len(blob), time.time()))
+        self._puts += 1
+        if self.max_bytes is not None and self._puts % 100 == 0:
+            self.evict()
+
+    # Drop the least recently used results until the store is back under 90% of max_bytes
+    def evict(self, max_bytes=None):
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        conn = self._connect()
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+        if max_bytes is None or total <= max_bytes:
+            return 0
+        target = total - int(0.9 * max_bytes)
+        freed = 0
+        dropped = 0
+        for row in conn.execute('SELECT rowid, size FROM results ORDER BY accessed').fetchall():
+            if freed >= target:
+                break
+            conn.execute('DELETE FROM results WHERE rowid=?', (row[0],))
+            freed += row[1]
+            dropped += 1
+        return dropped
+
+    def __len__(self):
+        return self._connect().execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+    def stats(self):
+        n, total = self._connect().execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results').fetchone()
+        return {'results' : n, 'bytes' : total, 'hits' : self.hits, 'misses' : self.misses}
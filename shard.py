@@ -0,0 +1,500 @@
+import os
+import sys
+import json
+import time
+import pickle
+import socket
+import random
+import argparse
+import traceback
+from collections import Counter
+from multiprocessing import Process
+import RNA
+from utils import parse_dp_file, md_settings, make_md
+from folder import CotranscriptionalFolder, MODES, result_structure
+from results import portable
+from sweep import grouped_pathways, parse_params, DEDUP_MODES
+
+# Sweeps too big for one machine, e.g. all of RNAstrand_noMS_noPK.dp at every penalty value of every mode.
+# init splits the (record, mode, penalty) pathways into shards once, in a fixed order, and writes them to a job directory.
+# Any number of `work` processes on any number of hosts pointed at that directory (a shared filesystem, or just a local
+# directory for one machine) claim shards and fold them, then `merge` puts the notebook dicts back together:
+#
+#     python shard.py init job RNAstrand/RNAstrand_noMS_noPK.dp --grid constant_penalty=0:20:1 --grid sequence_dependent_penalty=0:0.4:0.025
+#     python shard.py work job -p 8          on every host, as many times as you like
+#     python shard.py status job
+#     python shard.py merge job -o samples.pkl    {mode : samples[name][param][length]}, same as sweep.py per mode
+#
+# The job directory holds
+#     job.json, records.json     the grid, md settings and every shard's pathways, and the sequences
+#     locks/<shard>.<attempt>.lock   created with O_EXCL, so only one worker gets each attempt at a shard
+#     checkpoints/<shard>.pkl    the pathways so far, rewritten every few minutes, a retry picks up from here
+#     done/<shard>.pkl           finished shards, written to a temp file and renamed so they're never half there
+#     failed/<shard>.<attempt>.txt   the traceback when an attempt crashed
+# A worker keeps touching the locks it holds.  A lock that hasn't been touched for the lease is an abandoned shard
+# (host died, job killed) and the next worker claims the attempt after it, until max_attempts have been used up.
+# Vienna holds the GIL while it folds, so the heartbeat can't come from a thread: every shard runs in its own
+# process and the worker process only claims, touches locks and starts the next shard.
+# The lease needs to be a lot longer than the clock skew between hosts, the lock times come from their clocks.
+
+JOB_FILE = 'job.json'
+RECORDS_FILE = 'records.json'
+DIRS = ['locks', 'checkpoints', 'done', 'failed']
+
+SHARD_SIZE = 20000 # in folds of a 100 nt prefix, a few minutes of MFE folding
+LEASE = 600
+MAX_ATTEMPTS = 3
+CHECKPOINT = 120
+CHUNK = 10 # lengths folded between checkpoint checks in the grouped modes
+
+def _shard_name(shard):
+    return f"{shard:05d}"
+
+def _worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+# Write to a temp file next to filename and rename it into place, so readers never see a partial file
+def _write_atomic(filename, data):
+    tmp = f"{filename}.{socket.gethostname()}.{os.getpid()}.tmp"
+    with open(tmp, 'wb' if type(data) == bytes else 'w') as f:
+        f.write(data)
+    os.replace(tmp, filename)
+
+##################################
+###           SHARDS           ###
+##################################
+
+# Rough cost of folding a record at every length from min_length, MFE is O(n^3)
+def fold_cost(n, min_length=11):
+    return sum((l / 100)**3 for l in range(min_length, n+1))
+
+# Split every (record, mode, penalty) pathway into shards of about shard_size, always in the same order
+# Each shard is a list of [record, mode, [param indices]].  A record's values stay in one piece wherever they fit,
+# so the DEDUP_MODES can share folds between them, records too big for that get split over the values.
+def make_shards(records, grid, min_length=11, shard_size=SHARD_SIZE):
+    shards = []
+    current = []
+    cost = 0
+    for mode, params in grid.items():
+        for name, seq in records.items():
+            c = fold_cost(len(seq), min_length)
+            per = len(params) if c == 0 else max(1, int(shard_size // c))
+            for i in range(0, len(params), per):
+                piece = list(range(i, min(i+per, len(params))))
+                if current and cost + c * len(piece) > shard_size:
+                    shards.append(current)
+                    current = []
+                    cost = 0
+                current.append([name, mode, piece])
+                cost += c * len(piece)
+    if current:
+        shards.append(current)
+    return shards
+
+# Set up a job directory.  Running it again with the same arguments does nothing, with anything else it's an error
+# records is {name : seq}, grid is {mode : [params]}
+def init_job(job, records, grid, md=None, min_length=11, shard_size=SHARD_SIZE, lease=LEASE, max_attempts=MAX_ATTEMPTS,
+             checkpoint=CHECKPOINT, backend=None, source=None, sampler_seed=None):
+    for mode in grid.keys():
+        if mode not in MODES:
+            raise ValueError(f"Can't shard '{mode}', expected one of {list(MODES.keys())}")
+    grid = {mode : [float(p) for p in params] for mode, params in grid.items()}
+    spec = {
+        'source' : source,
+        'grid' : grid,
+        'settings' : md_settings(RNA.md() if md is None else md),
+        'min_length' : min_length,
+        'backend' : backend,
+        'sampler_seed' : sampler_seed,
+        'lease' : lease,
+        'max_attempts' : max_attempts,
+        'checkpoint' : checkpoint,
+        'shards' : make_shards(records, grid, min_length, shard_size)
+    }
+
+    filename = os.path.join(job, JOB_FILE)
+    if os.path.exists(filename):
+        existing, existing_records = load_job(job)
+        if existing != json.loads(json.dumps(spec)) or existing_records != records:
+            raise ValueError(f"{job} already holds a different job, use another directory")
+        return existing
+
+    for d in DIRS:
+        os.makedirs(os.path.join(job, d), exist_ok=True)
+    _write_atomic(os.path.join(job, RECORDS_FILE), json.dumps(records))
+    _write_atomic(filename, json.dumps(spec)) # last, a job.json means the job is all there
+    return spec
+
+def load_job(job):
+    with open(os.path.join(job, JOB_FILE), 'r') as f:
+        spec = json.load(f)
+    with open(os.path.join(job, RECORDS_FILE), 'r') as f:
+        records = json.load(f)
+    return spec, records
+
+##################################
+###           LOCKS            ###
+##################################
+
+def _lock_file(job, shard, attempt):
+    return os.path.join(job, 'locks', f"{_shard_name(shard)}.{attempt}.lock")
+
+def _done_file(job, shard):
+    return os.path.join(job, 'done', f"{_shard_name(shard)}.pkl")
+
+# Only one process can create a given attempt's lock
+def _try_lock(job, shard, attempt):
+    filename = _lock_file(job, shard, attempt)
+    try:
+        fd = os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except FileExistsError:
+        return None
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'worker' : _worker_id(), 'attempt' : attempt, 'claimed' : time.time()}, f)
+    return filename
+
+# Where every shard is at: [(state, latest attempt)], state is one of
+#     done, running (lock touched within the lease), stale (abandoned or crashed, can be retried),
+#     failed (stale and out of attempts), pending (never claimed, or its lock was given back)
+def shard_states(job, spec):
+    done = set(os.listdir(os.path.join(job, 'done')))
+    latest = {}
+    for f in os.listdir(os.path.join(job, 'locks')):
+        if f.endswith('.lock'):
+            name, attempt, _ = f.split('.')
+            latest[name] = max(latest.get(name, -1), int(attempt))
+
+    now = time.time()
+    states = []
+    for shard in range(len(spec['shards'])):
+        name = _shard_name(shard)
+        if name + '.pkl' in done:
+            states.append(('done', latest.get(name)))
+            continue
+        if name not in latest:
+            states.append(('pending', None))
+            continue
+        attempt = latest[name]
+        try:
+            fresh = now - os.stat(_lock_file(job, shard, attempt)).st_mtime < spec['lease']
+        except FileNotFoundError:
+            # Gone since the listdir: either its worker finished it, or it was interrupted and gave the lock back,
+            # in which case the shard is back to where it was before that attempt was claimed
+            if os.path.exists(_done_file(job, shard)):
+                states.append(('done', attempt))
+            else:
+                states.append(('pending', attempt - 1 if attempt > 0 else None))
+            continue
+        if fresh:
+            states.append(('running', attempt))
+        elif attempt + 1 >= spec['max_attempts']:
+            states.append(('failed', attempt))
+        else:
+            states.append(('stale', attempt))
+    return states
+
+# Claim the next pending or abandoned shard, returns (shard, attempt, lock file) or None if there isn't one
+# Workers start looking at different places so they don't all fight over the same shard
+def claim(job, spec, rng, states=None):
+    states = shard_states(job, spec) if states is None else states
+    candidates = [i for i, (s, _) in enumerate(states) if s in ['pending', 'stale']]
+    if len(candidates) == 0:
+        return None
+    offset = rng.randrange(len(candidates))
+    for shard in candidates[offset:] + candidates[:offset]:
+        state, attempt = states[shard]
+        attempt = 0 if attempt is None else attempt + 1
+        lock = _try_lock(job, shard, attempt)
+        if lock is None:
+            continue
+        if os.path.exists(_done_file(job, shard)): # finished by the worker we thought had given up
+            os.remove(lock)
+            continue
+        return shard, attempt, lock
+    return None
+
+# Someone decided this attempt was abandoned and took the shard over
+def _superseded(job, shard, attempt):
+    return os.path.exists(_lock_file(job, shard, attempt + 1))
+
+##################################
+###          FOLDING           ###
+##################################
+
+# Fold one shard, saving a checkpoint every spec['checkpoint'] seconds
+# checkpoints are {(record, mode, param index) : {'pathway' : {length : db}, 'state' : (length, result) or None}}
+def run_shard(job, shard, attempt):
+    spec, records = load_job(job)
+    md = make_md(spec['settings'])
+    backend = spec['backend']
+    checkpoint = os.path.join(job, 'checkpoints', f"{_shard_name(shard)}.pkl")
+    start = time.time()
+
+    entries = {}
+    if os.path.exists(checkpoint):
+        with open(checkpoint, 'rb') as f:
+            entries = pickle.load(f)
+    saved = [time.time()]
+    def save(force=False):
+        if force or time.time() - saved[0] > spec['checkpoint']:
+            _write_atomic(checkpoint, pickle.dumps(entries))
+            saved[0] = time.time()
+
+    folds = 0
+    for record, mode, piece in spec['shards'][shard]:
+        seq = records[record]
+        lengths = list(range(spec['min_length'], len(seq)+1))
+        keys = [(record, mode, i) for i in piece]
+        for k in keys:
+            entries.setdefault(k, {'pathway' : {}, 'state' : None})
+
+        if mode in DEDUP_MODES and backend != 'callback':
+            # All the values in a piece are checkpointed together, so they've all got as far as each other
+            todo = [k for k in keys if len(entries[k]['pathway']) < len(lengths)]
+            params = [spec['grid'][mode][i] for _, _, i in todo]
+            for c in range(len(entries[todo[0]]['pathway']) if todo else len(lengths), len(lengths), CHUNK):
+                last = [entries[k]['pathway'][lengths[c-1]] if c > 0 else '' for k in todo]
+                pathways, n = grouped_pathways(seq, mode, params, lengths[c:c+CHUNK], md, last=last)
+                for k, p in zip(todo, params):
+                    entries[k]['pathway'].update(pathways[p])
+                folds += n
+                save()
+            continue
+
+        for k in keys:
+            entry = entries[k]
+            folder = CotranscriptionalFolder(seq, mode, spec['grid'][mode][k[2]], lengths=lengths, md=md, backend=backend,
+                                             seed=spec.get('sampler_seed'))
+            if entry['state'] is not None:
+                folder.resume(*entry['state'])
+            for length in lengths[len(entry['pathway']):]:
+                result = folder.step(length)
+                entry['pathway'][length] = result_structure(result)
+                entry['state'] = (length, portable(result))
+                folds += 1
+                save()
+
+    out = {'worker' : _worker_id(), 'attempt' : attempt, 'seconds' : time.time() - start, 'folds' : folds,
+           'pathways' : {k : e['pathway'] for k, e in entries.items()}}
+    _write_atomic(_done_file(job, shard), pickle.dumps(out))
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+# run_shard in its own process, a crash leaves its traceback in failed/
+def _shard_process(job, shard, attempt):
+    try:
+        run_shard(job, shard, attempt)
+    except Exception:
+        _write_atomic(os.path.join(job, 'failed', f"{_shard_name(shard)}.{attempt}.txt"), f"{_worker_id()}\n{traceback.format_exc()}")
+        sys.exit(1)
+
+# Claim and fold shards until there are none left, running up to processes of them at once
+# With wait the worker hangs around while other workers still hold shards, in case they're abandoned
+# Returns (shards finished, shards that failed)
+def work(job, processes=1, wait=True, max_shards=None, progress=True):
+    spec, _ = load_job(job)
+    beat = max(1, spec['lease'] / 10)
+    rng = random.Random(_worker_id())
+    running = {} # shard -> (process, attempt, lock)
+    preempted = set()
+    finished = failed = started = 0
+    last_beat = time.time()
+
+    def log(msg):
+        if progress:
+            print(f"[{_worker_id()} {time.strftime('%H:%M:%S')}] {msg}", file=sys.stderr)
+
+    try:
+        while True:
+            for shard, (proc, attempt, lock) in list(running.items()):
+                if proc.is_alive():
+                    continue
+                proc.join()
+                del running[shard]
+                if proc.exitcode == 0:
+                    finished += 1
+                    log(f"shard {_shard_name(shard)} done")
+                    if os.path.exists(lock):
+                        os.remove(lock)
+                elif shard in preempted:
+                    preempted.discard(shard)
+                else:
+                    failed += 1
+                    log(f"shard {_shard_name(shard)} attempt {attempt} failed (exit code {proc.exitcode})")
+                    if os.path.exists(lock):
+                        os.utime(lock, (0, 0)) # stale straight away, so it's retried
+
+            if time.time() - last_beat >= beat:
+                for shard, (proc, attempt, lock) in running.items():
+                    try:
+                        if _superseded(job, shard, attempt):
+                            raise FileNotFoundError
+                        os.utime(lock)
+                    except FileNotFoundError:
+                        log(f"shard {_shard_name(shard)} was taken over by another worker, stopping")
+                        preempted.add(shard)
+                        proc.terminate()
+                last_beat = time.time()
+
+            claimed = None
+            if len(running) < processes and (max_shards is None or started < max_shards):
+                states = shard_states(job, spec)
+                claimed = claim(job, spec, rng, states)
+                if claimed is not None:
+                    shard, attempt, lock = claimed
+                    proc = Process(target=_shard_process, args=(job, shard, attempt))
+                    proc.start()
+                    running[shard] = (proc, attempt, lock)
+                    started += 1
+                    log(f"claimed shard {_shard_name(shard)} attempt {attempt}")
+                    continue
+                if len(running) == 0:
+                    others = sum(s == 'running' for s, _ in states)
+                    if not wait or others == 0:
+                        break
+            elif len(running) == 0:
+                break
+            time.sleep(1 if running else beat)
+    finally:
+        # Give back whatever was interrupted, the next worker to claim it carries on from its checkpoint
+        # (the lock is removed rather than left stale so the interruption doesn't use up an attempt)
+        for shard, (proc, attempt, lock) in running.items():
+            proc.terminate()
+            proc.join()
+            if os.path.exists(lock):
+                os.remove(lock)
+
+    return finished, failed
+
+##################################
+###       STATUS & MERGE       ###
+##################################
+
+def status(job):
+    spec, records = load_job(job)
+    states = shard_states(job, spec)
+    costs = [sum(fold_cost(len(records[r]), spec['min_length']) * len(piece) for r, _, piece in s) for s in spec['shards']]
+    counts = Counter(s for s, _ in states)
+    workers = Counter()
+    for shard, (s, attempt) in enumerate(states):
+        if s == 'running':
+            try:
+                with open(_lock_file(job, shard, attempt), 'r') as f:
+                    workers[json.load(f)['worker']] += 1
+            except (FileNotFoundError, ValueError):
+                pass
+    failures = {}
+    for f in sorted(os.listdir(os.path.join(job, 'failed'))):
+        with open(os.path.join(job, 'failed', f), 'r') as fh:
+            lines = fh.read().strip().splitlines()
+        failures[f[:-len('.txt')]] = lines[-1] if lines else ''
+    return {
+        'shards' : len(states),
+        'states' : dict(counts),
+        'done_fraction' : sum(c for c, (s, _) in zip(costs, states) if s == 'done') / max(sum(costs), 1e-9),
+        'workers' : dict(workers),
+        'failures' : failures,
+        'failed_shards' : [_shard_name(i) for i, (s, _) in enumerate(states) if s == 'failed']
+    }
+
+# {mode : samples[name][param][length]}, with the same keys in the same order sweep.run_sweep gives
+# Shards that aren't done leave None where their pathways go with partial, otherwise it's an error
+def merge(job, partial=False):
+    spec, records = load_job(job)
+    out = {mode : {name : {p : None for p in params} for name in records.keys()} for mode, params in spec['grid'].items()}
+    missing = []
+    for shard in range(len(spec['shards'])):
+        try:
+            with open(_done_file(job, shard), 'rb') as f:
+                done = pickle.load(f)
+        except FileNotFoundError:
+            missing.append(_shard_name(shard))
+            continue
+        for (name, mode, i), pathway in done['pathways'].items():
+            out[mode][name][spec['grid'][mode][i]] = pathway
+    if missing and not partial:
+        raise RuntimeError(f"{len(missing)} of {len(spec['shards'])} shards aren't done yet (first: {missing[0]}), see `shard.py status`")
+    return out
+
+# --grid constant_penalty=0:20:1, a mode on its own gets a single value of 0
+def parse_grid(s):
+    mode, _, params = s.partition('=')
+    return mode, parse_params(params) if params else [0.0]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='shard', description='Split a big sweep into shards that any number of workers on any number of hosts can fold')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('init', help='Split a .dp dataset and penalty grid into shards in a job directory')
+    p.add_argument('job', help='Job directory, somewhere every worker can see')
+    p.add_argument('dataset', help='RNA STRAND .dp file')
+    p.add_argument('-g', '--grid', type=parse_grid, action='append', required=True, metavar='MODE=PARAMS',
+                   help='A folding mode and its penalty values (start:stop:step or a comma separated list), repeat for more modes')
+    p.add_argument('-T', '--temperature', type=float, default=37, help='Folding temperature')
+    p.add_argument('--min-length', type=int, default=11, help='Shortest prefix to fold')
+    p.add_argument('--max-seq-length', type=int, default=None, help='Only use sequences shorter than this')
+    p.add_argument('--sample', type=int, default=None, help='Randomly choose this many sequences')
+    p.add_argument('--seed', type=int, default=1337, help='Seed for --sample and the Boltzmann sampler')
+    p.add_argument('--backend', default=None, choices=['native', 'callback'], help='Penalty backend')
+    p.add_argument('--shard-size', type=float, default=SHARD_SIZE, help='Work per shard, in folds of a 100 nt prefix')
+    p.add_argument('--lease', type=float, default=LEASE, help="Seconds without a heartbeat before a shard counts as abandoned")
+    p.add_argument('--max-attempts', type=int, default=MAX_ATTEMPTS, help='Give up on a shard after this many claims')
+    p.add_argument('--checkpoint', type=float, default=CHECKPOINT, help='Seconds between checkpoints while folding a shard')
+
+    p = sub.add_parser('work', help='Claim and fold shards until there are none left')
+    p.add_argument('job', help='Job directory')
+    p.add_argument('-p', '--processes', type=int, default=1, help='Shards to fold at once')
+    p.add_argument('--no-wait', action='store_true', help="Stop once there's nothing to claim instead of waiting to see if other workers' shards are abandoned")
+    p.add_argument('--max-shards', type=int, default=None, help='Stop after claiming this many shards')
+
+    p = sub.add_parser('status', help='Show how far a job has got')
+    p.add_argument('job', help='Job directory')
+
+    p = sub.add_parser('merge', help='Put the finished shards back together into the notebook dicts')
+    p.add_argument('job', help='Job directory')
+    p.add_argument('-o', '--output', default='samples.pkl', help='Where to pickle {mode : samples}')
+    p.add_argument('-m', '--mode', default=None, help='Only write samples[name][param][length] for this mode, like sweep.py')
+    p.add_argument('--partial', action='store_true', help="Merge what's done, unfinished pathways are None")
+    args = parser.parse_args(argv)
+
+    if args.command == 'init':
+        dataset = parse_dp_file(args.dataset)
+        if args.max_seq_length is not None:
+            dataset = {k : v for k, v in dataset.items() if len(v['seq']) < args.max_seq_length}
+        if args.sample is not None:
+            random.seed(args.seed)
+            dataset = {k : dataset[k] for k in random.choices(list(dataset.keys()), k=args.sample)}
+        md = RNA.md()
+        md.temperature = args.temperature
+        spec = init_job(args.job, {k : v['seq'] for k, v in dataset.items()}, dict(args.grid), md, args.min_length, args.shard_size,
+                        args.lease, args.max_attempts, args.checkpoint, args.backend, os.path.abspath(args.dataset), args.seed)
+        n = sum(len(spec['grid'][mode]) for mode in spec['grid'].keys()) * len(dataset)
+        print(f"{len(spec['shards'])} shards, {n} pathways over {len(dataset)} records in {args.job}")
+
+    elif args.command == 'work':
+        finished, failed = work(args.job, args.processes, not args.no_wait, args.max_shards)
+        print(f"Finished {finished} shards, {failed} failed")
+        return 1 if failed else 0
+
+    elif args.command == 'status':
+        s = status(args.job)
+        print(f"{s['shards']} shards: " + ', '.join(f"{n} {state}" for state, n in sorted(s['states'].items())))
+        print(f"{s['done_fraction']:.1%} of the work done")
+        for worker, n in s['workers'].items():
+            print(f"  {worker} running {n}")
+        for name, line in s['failures'].items():
+            print(f"  failed {name}: {line}")
+        if s['failed_shards']:
+            print(f"Out of attempts: {' '.join(s['failed_shards'])}")
+
+    elif args.command == 'merge':
+        samples = merge(args.job, args.partial)
+        if args.mode is not None:
+            samples = samples[args.mode]
+        with open(args.output, 'wb') as f:
+            pickle.dump(samples, f)
+        print(f"Wrote {args.output}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,342 @@
+import RNA
+import os
+import numpy as np
+import argparse
+import pickle
+import sys
+import time
+from math import ceil
+from multiprocessing import Pool
+from random import choices, seed
+from utils import parse_dp_file, parse_rdat, md_settings, make_md, pair_table
+from folder import CotranscriptionalFolder, MODES, ADAPTIVE_MODES
+import penalties
+from penalties import (use_result_store, constant_penalty_matrix, sequence_dependent_penalty_matrix, add_penalty_matrix, get_penalties,
+                       shape_fold, shape_reactivities, shape_key, SHAPE_CACHE)
+from results import ResultStore
+
+# Every (sequence, penalty) pathway is independent, so a parameter sweep is just a pile of pathways
+# that can be spread over a process pool.  Results come back in the same nested shape the notebooks build:
+#     samples[name][param][length] = mfe structure
+# With a result store (see results.py) every fold is saved as it's computed,
+# so re-running an interrupted sweep only folds the lengths that didn't finish.
+# With adaptive set the MFE modes stride over the lengths where the structure just grows an unpaired tail (see CotranscriptionalFolder.run_adaptive).
+
+# Turn a dataset into {name : (seq, lengths)}
+# parse_dp_file gives {name : {'seq', 'db'}}, each one is folded from min_length to its full length
+# parse_rdat gives {length : {'seq', 'react'}}, which is a single construct series folded at the measured lengths
+def dataset_pathways(dataset, name='rdat', min_length=11):
+    if all(type(k) == int for k in dataset.keys()):
+        lengths = sorted(dataset.keys())
+        return {name : (dataset[lengths[-1]]['seq'], lengths)}
+
+    return {k : (v['seq'], list(range(min_length, len(v['seq'])+1))) for k, v in dataset.items()}
+
+# One unit of work for the pool
+def _run_pathway(task):
+    name, i, seq, lengths, mode, param, settings, backend, store, adaptive, sampler_seed = task
+    if store is not None:
+        use_result_store(store)
+    folder = CotranscriptionalFolder(seq, mode, param, lengths=lengths, md=make_md(settings), backend=backend, seed=sampler_seed)
+    if adaptive is not None:
+        pathway, folds = folder.run_adaptive(adaptive)
+        return name, i, pathway, folds
+    return name, i, folder.run(), len(folder.lengths)
+
+# One sequence at every parameter value, for the DEDUP_MODES
+def _run_grouped(task):
+    name, seq, lengths, mode, params, settings, store = task
+    pathways, folds = grouped_pathways(seq, mode, params, lengths, make_md(settings), store)
+    return name, pathways, folds
+
+##################################
+###    SHARED PREFIX FOLDING   ###
+##################################
+
+# In the MFE modes a step only depends on the prefix, the last structure and the penalty matrix built from them.
+# Across a sweep lots of parameter values sit on the same last structure for long stretches
+# (at short lengths they usually all do, and percent=0 is just no_constraint),
+# so the values are grouped by last structure at every step and each distinct penalty matrix is folded once.
+# On top of that, if the penalties are all >= 0 and the unconstrained MFE doesn't break any pair it would be
+# penalized for, it's the MFE at every one of those values too and only one fold is needed for the group.
+DEDUP_MODES = ['no_constraint', 'constant_penalty', 'sequence_dependent_penalty']
+
+def _dedup_matrix(mode, length, last_pt, penalties, param):
+    if mode == 'constant_penalty':
+        M = constant_penalty_matrix(length, last_pt, param)
+    elif mode == 'sequence_dependent_penalty':
+        M = sequence_dependent_penalty_matrix(length, last_pt, penalties, param)
+    else:
+        M = np.zeros((length+1, length+1))
+    return np.triu(M, 1)
+
+# Fold one sequence at every value in params, sharing folds between values wherever the state matches
+# Returns ({param : {length : structure}}, number of folds actually done)
+# last carries on from the structure each value ended at, to continue pathways that were stopped part way
+def grouped_pathways(seq, mode, params, lengths, md=None, store=None, last=None):
+    md = RNA.md() if md is None else md
+    pathways = [{} for p in params]
+    last = ['' for p in params] if last is None else list(last)
+    folds = 0
+
+    for length in lengths:
+        subseq = seq[:length]
+        results = [None] * len(params)
+
+        if store is not None:
+            keys = [store.key(mode, subseq, 0, '', md) if mode == 'no_constraint' else store.key(mode, subseq, p, l, md)
+                    for p, l in zip(params, last)]
+            results = [store.get(k) for k in keys]
+
+        groups = {}
+        for i, l in enumerate(last):
+            if results[i] is None:
+                groups.setdefault(l, []).append(i)
+
+        for l, members in groups.items():
+            last_pt = pair_table(l)
+            penalties = np.zeros(1, dtype=np.int32)
+            if mode == 'sequence_dependent_penalty' and l != '':
+                penalties = get_penalties(l, RNA.fold_compound(seq[:len(l)], md))
+
+            # Values with the same matrix fold identically
+            matrices = {}
+            for i in members:
+                M = _dedup_matrix(mode, length, last_pt, penalties, params[i])
+                matrices.setdefault(M.tobytes(), (M, []))[1].append(i)
+
+            plain = None
+            if len(matrices) > 1 and all((M >= 0).all() for M, _ in matrices.values()):
+                plain = RNA.fold_compound(subseq, md).mfe()
+                folds += 1
+                pt = pair_table(plain[0])
+                opening = np.nonzero(pt[1:] > np.arange(1, len(pt)))[0] + 1
+                if all(not M[opening, pt[opening]].any() for M, _ in matrices.values()):
+                    for i in members:
+                        results[i] = plain
+                    continue
+
+            for M, group in matrices.values():
+                if not M.any() and plain is not None:
+                    result = plain
+                else:
+                    fc = RNA.fold_compound(subseq, md)
+                    add_penalty_matrix(fc, M)
+                    result = fc.mfe()
+                    folds += 1
+                for i in group:
+                    results[i] = result
+
+            if store is not None:
+                for i in members:
+                    store.put(keys[i], results[i])
+
+        for i, result in enumerate(results):
+            pathways[i][length] = result[0]
+            last[i] = result[0]
+
+    return {p : pathway for p, pathway in zip(params, pathways)}, folds
+
+##################################
+###           SWEEPS           ###
+##################################
+
+# Fold every pathway in dataset at every value in params
+# func is one of the folding functions in penalties.py (or its name)
+# processes=1 runs everything in this process, None uses every core
+# store is a results.ResultStore (or the path of one) to read through and save into
+# dedup folds all the values of one pathway together (see grouped_pathways) in the modes that allow it
+# sampler_seed seeds the modes that draw Boltzmann samples, so they come out the same every run and can be stored
+def run_sweep(dataset, func, params, md=None, processes=None, chunksize=1, name='rdat', min_length=11, backend=None, progress=True, store=None, dedup=True, adaptive=None,
+              sampler_seed=None):
+    mode = func if type(func) == str else func.__name__
+    if mode not in MODES:
+        raise ValueError(f"Can't sweep over '{mode}', expected one of {list(MODES.keys())}")
+    if adaptive is not None and mode not in ADAPTIVE_MODES:
+        raise ValueError(f"Only {ADAPTIVE_MODES} can be stepped adaptively, not '{mode}'")
+    settings = md_settings(RNA.md() if md is None else md)
+    if type(store) == str:
+        store = ResultStore(store)
+
+    pathways = dataset_pathways(dataset, name, min_length)
+    # The longest pathways go first so one of them doesn't end up running alone at the end
+    order = sorted(pathways.keys(), key=lambda k: -len(pathways[k][0]))
+    grouped = dedup and mode in DEDUP_MODES and backend != 'callback' and adaptive is None
+    if grouped:
+        worker = _run_grouped
+        # With fewer pathways than processes (an rdat dataset is a single pathway) the values are split into runs
+        # of neighbouring values, which are the ones most likely to share folds, so every process gets some
+        n = 1 if processes == 1 else (os.cpu_count() or 1) if processes is None else processes
+        size = ceil(len(params) / max(1, min(len(params), n // max(len(pathways), 1))))
+        tasks = [(k, pathways[k][0], pathways[k][1], mode, params[c:c+size], settings, store) for k in order for c in range(0, len(params), size)]
+    else:
+        worker = _run_pathway
+        tasks = [(k, i, pathways[k][0], pathways[k][1], mode, p, settings, backend, store, adaptive, sampler_seed) for k in order for i, p in enumerate(params)]
+    total = len(pathways) * len(params)
+    # Every pathway folds every one of its lengths once without dedup
+    unshared = len(params) * sum(len(pathways[k][1]) for k in pathways.keys())
+
+    # Fill in the keys up front so the output is ordered the same as the input
+    samples = {k : {p : None for p in params} for k in pathways.keys()}
+
+    if processes == 1:
+        results = map(worker, tasks)
+        pool = None
+        previous = penalties.RESULT_STORE
+    else:
+        pool = Pool(processes)
+        results = pool.imap_unordered(worker, tasks, chunksize)
+
+    start = time.time()
+    done = 0
+    folds = 0
+    try:
+        for result in results:
+            if grouped:
+                k, pathway, n = result
+                samples[k].update(pathway)
+                done += len(pathway)
+                folds += n
+            else:
+                k, i, pathway, n = result
+                samples[k][params[i]] = pathway
+                done += 1
+                folds += n
+            if progress:
+                elapsed = time.time() - start
+                print(f"\r{done}/{total} pathways, {elapsed:.0f}s elapsed, ~{elapsed / done * (total - done):.0f}s left", end='', file=sys.stderr)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        else:
+            use_result_store(previous)
+    if progress:
+        print(file=sys.stderr)
+        if grouped or adaptive is not None:
+            print(f"Folded {folds} times instead of {unshared}, saved {unshared - folds} folds ({(unshared - folds) / max(unshared, 1):.0%})", file=sys.stderr)
+        if store is not None:
+            print(f"Result store {store.path}: {store.stats()['results']} folds saved", file=sys.stderr)
+
+    return samples
+
+##################################
+###       SHAPE PATHWAYS       ###
+##################################
+
+# The SHAPE pathways the notebooks build one fold at a time:
+#     for n, d in shape_data.items():
+#         for length in d.keys():
+#             d[length]['mfe'] = shape_constraint(d[length]['seq'], d[length]['react'], md)[0]
+# Here every length is one unit of work for the pool.  The replicates measured at a length share one fold compound
+# (the energy parameters are only set up once) and just swap their soft constraints,
+# and anything already in penalties.SHAPE_CACHE isn't sent to the pool at all.
+
+def _shape_length(task):
+    length, seq, replicates, settings = task
+    md = make_md(settings)
+    fc = RNA.fold_compound(seq, md)
+    return length, seq, {name : shape_fold(fc, seq, react, md) for name, react in replicates}
+
+# Fills in d[length]['mfe'] for every replicate in shape_data ({name : {length : {'seq', 'react'}}},
+# e.g. RdatStore.shape_data() or the notebooks' dict).  Returns (shape_data, number of folds that weren't cached).
+def shape_pathways(shape_data, md=None, processes=None, progress=True):
+    md = RNA.md() if md is None else md
+    settings = md_settings(md)
+    lengths = sorted(set(l for d in shape_data.values() for l in d.keys()))
+
+    tasks = []
+    pending = {}
+    for l in lengths:
+        by_seq = {}
+        for n, d in shape_data.items():
+            if l not in d:
+                continue
+            seq = d[l]['seq']
+            react = shape_reactivities(d[l]['react'], len(seq))
+            cached = SHAPE_CACHE.get(shape_key(seq, react, md))
+            if cached is not None:
+                d[l]['mfe'] = cached[0]
+            else:
+                by_seq.setdefault(seq, []).append((n, react))
+                pending[(l, seq, n)] = react
+        tasks.extend((l, seq, replicates, settings) for seq, replicates in by_seq.items())
+    # The longest lengths go first so one of them doesn't end up running alone at the end
+    tasks.sort(key=lambda t: -t[0])
+
+    start = time.time()
+    folds = 0
+    if processes == 1 or len(tasks) <= 1:
+        results = map(_shape_length, tasks)
+        pool = None
+    else:
+        pool = Pool(processes)
+        results = pool.imap_unordered(_shape_length, tasks)
+    try:
+        for done, (l, seq, mfes) in enumerate(results):
+            for n, result in mfes.items():
+                shape_data[n][l]['mfe'] = result[0]
+                SHAPE_CACHE.put(shape_key(seq, pending[(l, seq, n)], md), result)
+            folds += len(mfes)
+            if progress:
+                print(f"\r{done+1}/{len(tasks)} lengths, {time.time() - start:.0f}s elapsed", end='', file=sys.stderr)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if progress and len(tasks) > 0:
+        print(file=sys.stderr)
+
+    return shape_data, folds
+
+# Read a parameter grid from the command line, either start:stop:step or a comma separated list
+def parse_params(s):
+    if ':' in s:
+        start, stop, step = [float(x) for x in s.split(':')]
+        return list(np.arange(start, stop, step))
+    return [float(x) for x in s.split(',')]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a penalty sweep over a .dp or rdat dataset on a process pool')
+    parser.add_argument('dataset', help='RNA STRAND .dp file or rdat file')
+    parser.add_argument('mode', choices=list(MODES.keys()), help='Folding function from penalties.py')
+    parser.add_argument('params', type=parse_params, help='Penalty values, either start:stop:step or a comma separated list')
+    parser.add_argument('-o', '--output', default='sweep.pkl', help='Where to pickle the samples dict')
+    parser.add_argument('-p', '--processes', type=int, default=None, help='Number of worker processes (default: all cores)')
+    parser.add_argument('-c', '--chunksize', type=int, default=1, help='Pathways handed to a worker at once')
+    parser.add_argument('-T', '--temperature', type=float, default=37, help='Folding temperature')
+    parser.add_argument('--min-length', type=int, default=11, help='Shortest prefix to fold (.dp only)')
+    parser.add_argument('--max-seq-length', type=int, default=None, help='Only use sequences shorter than this (.dp only)')
+    parser.add_argument('--sample', type=int, default=None, help='Randomly choose this many sequences (.dp only)')
+    parser.add_argument('--seed', type=int, default=1337, help='Seed for --sample and the Boltzmann sampler')
+    parser.add_argument('--store', default=None, help='sqlite result store to resume from and save every fold into')
+    parser.add_argument('--no-dedup', action='store_true', help="Fold every parameter value separately even where they'd share folds")
+    parser.add_argument('--adaptive', type=int, default=None, metavar='MAX_STRIDE', help='Stride over lengths where the structure only grows an unpaired tail, up to this many at once (turns off dedup)')
+    parser.add_argument('--store-max-mb', type=float, default=None, help='Evict the least recently used results past this size')
+    args = parser.parse_args(argv)
+
+    if args.dataset.endswith('.dp'):
+        dataset = parse_dp_file(args.dataset)
+        if args.max_seq_length is not None:
+            dataset = {k : v for k, v in dataset.items() if len(v['seq']) < args.max_seq_length}
+        if args.sample is not None:
+            seed(args.seed)
+            dataset = {k : dataset[k] for k in choices(list(dataset.keys()), k=args.sample)}
+    else:
+        dataset = parse_rdat(args.dataset)
+
+    md = RNA.md()
+    md.temperature = args.temperature
+
+    store = None
+    if args.store is not None:
+        store = ResultStore(args.store, None if args.store_max_mb is None else int(args.store_max_mb * 2**20))
+
+    samples = run_sweep(dataset, args.mode, args.params, md, args.processes, args.chunksize, min_length=args.min_length, store=store, dedup=not args.no_dedup, adaptive=args.adaptive,
+                        sampler_seed=args.seed)
+    with open(args.output, 'wb') as f:
+        pickle.dump(samples, f)
+    print(f"Wrote {sum(len(v) for v in samples.values())} pathways to {args.output}")
+
+if __name__ == '__main__':
+    main()
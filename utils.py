@@ -1,35 +1,128 @@
-
-from IPython.display import IFrame
 import numpy as np
+import RNA
+import os
+import json
+import glob
+import time
+from multiprocessing import Pool
+from functools import lru_cache
+
+# Model detail settings that get carried across processes and into cache keys
+# RNA.md can't be pickled, so workers rebuild it from these
+MD_FIELDS = ['temperature', 'betaScale', 'pf_smooth', 'dangles', 'special_hp', 'noLP', 'noGU', 'noGUclosure',
+             'logML', 'circ', 'gquad', 'uniq_ML', 'energy_set', 'backtrack', 'backtrack_type', 'compute_bpp',
+             'max_bp_span', 'min_loop_size', 'window_size', 'oldAliEn', 'ribo', 'cv_fact', 'nc_fact', 'sfact', 'salt']
+
+# Turn an RNA.md into a plain dict
+def md_settings(md):
+    return {f : getattr(md, f) for f in MD_FIELDS if hasattr(md, f)}
+
+# And back again
+def make_md(settings):
+    md = RNA.md()
+    for k, v in settings.items():
+        setattr(md, k, v)
+    return md
+
+##################################
+###        PAIR TABLES         ###
+##################################
+
+# The canonical structure representation is a pair table in ViennaRNA's ptable convention:
+#     pt[0] = length of the structure
+#     pt[i] = j if nucleotide i is paired to nucleotide j, 0 if i is unpaired
+# so nucleotides are 1-indexed (same as the i,j the soft constraint callbacks get) and each pair appears twice.
+# They're stored as int16 numpy arrays, which is plenty for anything that will fit through the DP.
+#
+# dict_dot_bracket and list_dot_bracket below are the older representations and are kept for the notebooks.
+
+# Turn a db string into a pair table
+# These get re-parsed constantly, so they're cached.  The arrays are read-only so the cache can't get corrupted.
+@lru_cache(maxsize=16384)
+def pair_table(db):
+    pt = np.zeros(len(db)+1, dtype=np.int16)
+    pt[0] = len(db)
+    open_stack = []
+    for i, c in enumerate(db, 1):
+        if c == '(':
+            open_stack.append(i)
+        elif c == ')':
+            j = open_stack.pop()
+            pt[i] = j
+            pt[j] = i
+    pt.flags.writeable = False
+
+    return pt
+
+# Turn anything that describes a structure into a pair table
+# strings are dot-brackets, integer arrays are assumed to already be pair tables,
+# dicts are dict_dot_bracket style and other lists/float arrays are list_dot_bracket style
+def as_pair_table(structure):
+    if type(structure) == str:
+        return pair_table(structure)
+    if isinstance(structure, np.ndarray) and np.issubdtype(structure.dtype, np.integer):
+        return structure
+    if type(structure) == dict:
+        raise ValueError("Can't get the length of a structure from a dict_dot_bracket dict, use the dot-bracket instead")
+
+    structure = np.asarray(structure)
+    pt = np.zeros(len(structure)+1, dtype=np.int16)
+    pt[0] = len(structure)
+    paired = structure >= 0
+    pt[1:][paired] = structure[paired] + 1
+
+    return pt
+
+# Turn a pair table back into a db string
+def dot_bracket(pt):
+    pt = as_pair_table(pt)
+    idx = np.arange(1, len(pt))
+    out = np.full(len(pt)-1, '.')
+    out[(pt[1:] != 0) & (pt[1:] > idx)] = '('
+    out[(pt[1:] != 0) & (pt[1:] < idx)] = ')'
+
+    return ''.join(out)
+
+##################################
+###          METRICS           ###
+##################################
+
+# If something in the full seq is paired to something which doesn't exist in the subseq
+# Then I don't think it counts as a missfold if that nucleotide is unpaired in the subseq fold
+def partial_ideal(ref):
+    # First we identify unclosed opening brackets
+    ref_transformed = []
+    pstack = []
+    for i, c in enumerate(ref):
+        ref_transformed.append(c)
+        if c == '(':
+            pstack.append(i)
+        if c == ')':
+            pstack.pop()
+
+    # And pretend those are unpaired.
+    for i in pstack:
+        ref_transformed[i] = '.'
+    
+    return(ref_transformed)
 
 # Calculate the matthews correlation coefficient
-# prediction and ref are both lists where unpaired=-1
+# prediction and ref can be db strings, pair tables or list_dot_bracket lists where unpaired=-1
 def calc_MCC(prediction, ref):
-    TP = 0
-    FP = 0
-    FN = 0
-    TN = 0
-
-    if type(prediction) == str:
-        prediction = list_dot_bracket(prediction)
-    if type(ref) == str:
-        ref = list_dot_bracket(ref)
-
-    for i in range(len(prediction)):
-        if ref[i] != -1:                # reference is paired
-            if prediction[i] == ref[i]: # correct pair predicted
-                TP += 1
-            elif prediction[i] == -1:   # predicted as unpaired
-                FN += 1
-            else:                       # incorrect pair predicted
-                FP += 1 
-        elif ref[i] == -1:              # reference is unpaired
-            if prediction[i] == ref[i]: # predicted as unpaired
-                TN += 1
-            else:                       # predicted is paired to something
-                FP += 1
-
-    MCC = ((TP * TN) - (FP * FN)) / np.sqrt((TP + FP) * (TP + FN) * (TN + FP) * (TN + FN))
+    prediction = as_pair_table(prediction)[1:]
+    ref = as_pair_table(ref)[1:]
+    n = min(len(prediction), len(ref))
+    prediction = prediction[:n]
+    ref = ref[:n]
+
+    same = prediction == ref
+    TP = int(np.sum((ref != 0) & same))          # correct pair predicted
+    FN = int(np.sum((ref != 0) & (prediction == 0))) # paired in reference, predicted as unpaired
+    TN = int(np.sum((ref == 0) & same))          # correctly predicted as unpaired
+    FP = n - TP - FN - TN                        # predicted paired to the wrong thing
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        MCC = ((TP * TN) - (FP * FN)) / np.sqrt(float((TP + FP) * (TP + FN) * (TN + FP) * (TN + FN)))
     # For example, when ref is all-unpaired string
     # TP + FN = 0 and this div by 0s
     if np.isnan(MCC):
@@ -38,6 +131,84 @@ def calc_MCC(prediction, ref):
 
     return MCC
 
+# Value used to pad pair tables of different lengths when they're stacked into one array
+# Padded positions are ignored by compare_structures
+PAD = -1
+
+# Stack structures (anything as_pair_table takes) into an (n_structures, width+1) pair table array
+# Shorter structures are padded out with PAD, column 0 keeps each structure's length
+def stack_pair_tables(structures, width=None):
+    structures = [as_pair_table(s) for s in structures]
+    if width is None:
+        width = max(len(s)-1 for s in structures)
+    out = np.full((len(structures), width+1), PAD, dtype=np.int16)
+    for i, s in enumerate(structures):
+        out[i, :len(s)] = s
+
+    return out
+
+# Stack a set of pathways ({length : db}) into a (n_pathways, n_lengths, width+1) array
+def stack_pathways(pathways, lengths):
+    width = max(lengths)
+    return np.stack([stack_pair_tables([p[l] for l in lengths], width) for p in pathways])
+
+# Vectorized calc_MCC
+# predictions has shape (P, ..., N+1) and references has shape (R, ..., N+1), both in the stack_pair_tables format
+# Every prediction is compared with every reference, so all the outputs have shape (P, R, ...)
+# Returns a dict with the confusion counts, MCC, hamming distance and base pair distance
+def compare_structures(predictions, references):
+    pred = np.asarray(predictions)[:, np.newaxis, ..., 1:]
+    ref = np.asarray(references)[np.newaxis, :, ..., 1:]
+    valid = (pred != PAD) & (ref != PAD)
+
+    ref_paired = valid & (ref > 0)
+    ref_unpaired = valid & (ref == 0)
+    same = pred == ref
+
+    TP = np.sum(ref_paired & same, axis=-1)
+    FN = np.sum(ref_paired & (pred == 0), axis=-1)
+    TN = np.sum(ref_unpaired & same, axis=-1)
+    FP = np.sum(valid & ~same, axis=-1) - FN
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        MCC = ((TP * TN) - (FP * FN)) / np.sqrt((TP + FP).astype(float) * (TP + FN) * (TN + FP) * (TN + FN))
+    # Same as calc_MCC, undefined MCCs (ie all-unpaired references) come out as -1
+    undefined = np.isnan(MCC)
+    if undefined.any():
+        print(f"WARNING: {np.sum(undefined)} undefined MCC.  Returning -1")
+        MCC[undefined] = -1
+
+    # Each broken pair shows up at both of its nucleotides
+    bp_distance = (np.sum(valid & (pred > 0) & ~same, axis=-1) + np.sum(valid & (ref > 0) & ~same, axis=-1)) // 2
+
+    return {
+        'TP' : TP,
+        'FP' : FP,
+        'FN' : FN,
+        'TN' : TN,
+        'MCC' : MCC,
+        'hamming' : np.sum(valid & ~same, axis=-1),
+        'bp_distance' : bp_distance
+    }
+
+# Stack equal-length db strings into an (n_structures, length) uint8 array of their characters
+def structure_matrix(structures):
+    if len(structures) == 0:
+        return np.zeros((0, 0), dtype=np.uint8)
+    return np.frombuffer(''.join(structures).encode(), dtype=np.uint8).reshape(len(structures), -1)
+
+# Character-wise hamming distance from every row of a structure_matrix to ref (a db string or list of characters)
+def hamming_distances(matrix, ref):
+    ref = np.frombuffer(''.join(ref).encode(), dtype=np.uint8)
+    return np.count_nonzero(matrix != ref, axis=1)
+
+# Base pair distance from every row of a stack_pair_tables array to the pair table ref, same as compare_structures
+def bp_distances(tables, ref):
+    tables = np.asarray(tables)[:, 1:]
+    ref = np.asarray(ref)[1:]
+    differ = tables != ref
+    return (np.count_nonzero(differ & (tables > 0), axis=1) + np.count_nonzero(differ & (ref > 0), axis=1)) // 2
+
 # Turn a db string into a dict
 def dict_dot_bracket(db):
     open_stack = []
@@ -128,48 +299,204 @@ def parse_drt_file(filename, ref_dict):
 
     return out_dict
 
-def parse_dp_file(filename):
-    with open(filename, 'r') as f:
-        lines = f.readlines()
-    
-    # These files are awful.  The sequence and db are split over multiple lines...
+##################################
+###     RNA STRAND .dp FILES   ###
+##################################
 
-    data = {}
-    currname = ''
-    currseq = ''
-    currdb = ''
+# These files are awful.  The sequence and db are split over multiple lines...
+# Each record starts with a '# File <name>.dp' line, then some more '#' header lines,
+# then the sequence lines, then the structure lines.
+# Modified nucleotides mean sequence lines can have pretty much anything in them (including dots),
+# so a line is only treated as structure if it's nothing but brackets and dots.
+DB_CHARS = '.()[]{}<>'
 
-    for l in lines:
-        if l.startswith('#') and ('.dp') in l: # this line contains a new filename
-            if currname != '':
-                data[currname] = {
-                    'seq' : currseq,
-                    'db' : currdb
-                }
-                currseq = ''
-                currdb = ''
-            currname = l.strip('# File .dp\n')
-        elif l.startswith('#'): # one of the other header lines
+def _dp_name(line):
+    name = line[len('# File '):].strip()
+    return name[:-3] if name.endswith('.dp') else name
+
+# Parse records out of an open (binary) .dp file, starting from wherever it is now
+# Yields (name, byte offset of the record, seq, db)
+def _read_dp_records(f):
+    name = None
+    offset = 0
+    pos = f.tell()
+    seq = []
+    db = []
+    for line in f:
+        line_start = pos
+        pos += len(line)
+        l = line.decode('utf-8').strip()
+        if l.startswith('# File'): # this line contains a new filename
+            if name is not None:
+                yield name, offset, ''.join(seq), ''.join(db)
+            name = _dp_name(l)
+            offset = line_start
+            seq = []
+            db = []
+        elif l.startswith('#') or l == '': # one of the other header lines
             continue
-        elif 'A' in l or 'U' in l or 'G' in l or 'C' in l:
-            currseq = currseq + l.strip()
-        elif '.' in l or '(' in l or ')' in l:
-            currdb = currdb + l.strip()
+        elif l.strip(DB_CHARS) == '':
+            db.append(l)
         else:
-            continue
+            seq.append(l)
 
-    data[currname] = {
-                'seq' : currseq,
-                'db' : currdb
-            }
-    
-    return data
+    if name is not None:
+        yield name, offset, ''.join(seq), ''.join(db)
+
+def _keep_record(name, length, min_length, max_length, names):
+    if min_length is not None and length < min_length:
+        return False
+    if max_length is not None and length > max_length:
+        return False
+    if names is not None and name not in names:
+        return False
+    return True
+
+# Offset index for a .dp file, stored next to it as <filename>.idx
+# It's a list of (name, byte offset, sequence length) and gets rebuilt whenever the .dp file changes.
+def dp_index(filename):
+    index_file = filename + '.idx'
+    stat = os.stat(filename)
+    try:
+        with open(index_file, 'r') as f:
+            index = json.load(f)
+        if index['size'] == stat.st_size and index['mtime'] == stat.st_mtime:
+            return index['records']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    with open(filename, 'rb') as f:
+        records = [[name, offset, len(seq)] for name, offset, seq, _ in _read_dp_records(f)]
+
+    try:
+        with open(index_file, 'w') as f:
+            json.dump({'size' : stat.st_size, 'mtime' : stat.st_mtime, 'records' : records}, f)
+    except OSError: # can't write next to the data, just don't keep it
+        pass
+
+    return records
+
+# Stream (name, {'seq', 'db'}) records out of a .dp file without reading the whole thing
+# Filter on sequence length (inclusive) and/or a collection of names.
+# With use_index the offset index is used to only parse the records that pass the filters.
+def iter_dp_file(filename, min_length=None, max_length=None, names=None, use_index=False):
+    with open(filename, 'rb') as f:
+        if not use_index:
+            for name, _, seq, db in _read_dp_records(f):
+                if _keep_record(name, len(seq), min_length, max_length, names):
+                    yield name, {'seq' : seq, 'db' : db}
+            return
+
+        for name, offset, length in dp_index(filename):
+            if not _keep_record(name, length, min_length, max_length, names):
+                continue
+            f.seek(offset)
+            _, _, seq, db = next(_read_dp_records(f))
+            yield name, {'seq' : seq, 'db' : db}
+
+# Pull a single record out of a .dp file using the index
+def read_dp_record(filename, name):
+    for _, record in iter_dp_file(filename, names={name}, use_index=True):
+        return record
+    raise KeyError(f"No record called {name} in {filename}")
+
+def parse_dp_file(filename, min_length=None, max_length=None, names=None, use_index=False):
+    return dict(iter_dp_file(filename, min_length, max_length, names, use_index))
+
+##################################
+###        DESIGN FILES        ###
+##################################
+
+# Design files are three lines: name, target structure, sequence
+
+# Expand command line inputs into design files
+# Globs are expanded, and directories are searched for files with match in the name like the scripts always did
+# match can also be a function of the file name, for other kinds of files
+def design_files(inputs, match='design'):
+    if type(match) == str:
+        match = lambda f, s=match: s in f
+    files = []
+    for i in inputs:
+        paths = sorted(glob.glob(i)) if glob.has_magic(i) else [i]
+        for p in paths:
+            if os.path.isdir(p):
+                files.extend(sorted(os.path.join(p, f) for f in os.listdir(p) if match(f) and os.path.isfile(os.path.join(p, f))))
+            else:
+                files.append(p)
+    # the same file can come in through more than one input
+    return list(dict.fromkeys(files))
+
+# Returns (name, target, seq), with the pseudoknot brackets removed from the target since Vienna can't make them
+def read_design(filename):
+    with open(filename, 'r') as design:
+        name = design.readline().strip()
+        target = design.readline().strip()
+        seq = design.readline().strip()
+
+    # No pseudoknots in RNAsubopt
+    target = target.replace('[', '.')
+    target = target.replace(']', '.')
+
+    return name, target, seq
+
+# Prefix for everything written about a design, foo_design.txt -> <out_dir>/foo_
+def design_prefix(filename, out_dir='.'):
+    name = os.path.basename(filename)
+    if name.endswith('design.txt'):
+        name = name[:-len('design.txt')]
+    else:
+        name = os.path.splitext(name)[0] + '_'
+    return os.path.join(out_dir, name)
+
+# Print a table of (file, {column : value}) rows for the end of a batch run
+def print_summary(rows, file=None):
+    if len(rows) == 0:
+        return
+    columns = list(rows[0][1].keys())
+    table = [['file'] + columns] + [[os.path.basename(f)] + [str(r.get(c, '')) for c in columns] for f, r in rows]
+    widths = [max(len(row[i]) for row in table) for i in range(len(table[0]))]
+    for n, row in enumerate(table):
+        print('  '.join(v.ljust(w) for v, w in zip(row, widths)), file=file)
+        if n == 0:
+            print('  '.join('-' * w for w in widths), file=file)
+
+# One design for the pool, whatever goes wrong only fails that file
+def _run_design(task):
+    func, f, out_dir, settings, columns = task
+    start = time.time()
+    try:
+        row, record = func(f, out_dir, settings)
+        status = 'ok'
+    except Exception as e:
+        row, record, status = {c : '' for c in columns}, None, f"failed: {e}"
+    return f, dict(row, seconds=f"{time.time() - start:.2f}", status=status), record
+
+# The batch scripts' main loop.  func(filename, out_dir, settings) writes one design's result record and returns
+# ({column : value}, record filename), columns are the ones it fills in for the summary table.
+# Designs are spread over a pool, the records are rendered once they're all done and the summary comes out in file order.
+# Returns the exit status, 1 if any design failed
+def run_designs(files, func, out_dir, settings, columns, processes=None, render=True):
+    tasks = [(func, f, out_dir, settings, columns) for f in files]
+
+    start = time.time()
+    if processes == 1:
+        rows = list(map(_run_design, tasks))
+    else:
+        with Pool(processes) as pool:
+            rows = list(pool.imap_unordered(_run_design, tasks))
+    rows.sort(key=lambda r: files.index(r[0]))
+    compute = time.time() - start
+
+    if render:
+        from render import render_files # matplotlib only ever gets imported here, after the workers are done
+        render_files([record for _, _, record in rows if record is not None], processes=processes)
+
+    print_summary([(f, row) for f, row, _ in rows])
+    print(f"{len(files)} designs in {time.time() - start:.1f}s ({compute:.1f}s computing)")
+    return 0 if all(row['status'] == 'ok' for _, row, _ in rows) else 1
 
 # Display in a Forna iframe
+# It lives in viz.py now so importing utils doesn't pull in IPython, this keeps it where the notebooks expect it
 def forna_display(seq, struct, cols={}):
-    col_str = '\\n'.join([f'{k}:{cols[k]}' for k in cols.keys()])
-    # Can we run FORNA in a notebook (I feel like I've done this before...)
-    forna_src = f'http://rna.tbi.univie.ac.at/forna/forna.html?id=url/name&sequence={seq}&structure={struct}&colors={col_str}'
-    #generate a unique id for our iframe
-    return IFrame(forna_src, 1000, 500)
-    # That was easy.
\ No newline at end of file
+    from viz import forna_display
+    return forna_display(seq, struct, cols)
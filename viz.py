@@ -0,0 +1,12 @@
+# Notebook display helpers, kept out of the folding code so pool workers and scripts never import IPython.
+# Everything here imports what it needs when it's called.
+
+# Display in a Forna iframe
+def forna_display(seq, struct, cols={}):
+    from IPython.display import IFrame
+    col_str = '\\n'.join([f'{k}:{cols[k]}' for k in cols.keys()])
+    # Can we run FORNA in a notebook (I feel like I've done this before...)
+    forna_src = f'http://rna.tbi.univie.ac.at/forna/forna.html?id=url/name&sequence={seq}&structure={struct}&colors={col_str}'
+    #generate a unique id for our iframe
+    return IFrame(forna_src, 1000, 500)
+    # That was easy.